@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+
+"""Benchmark the sprite detection stages on synthetic sprite sheets
+
+Every scenario builds a reproducible sheet from a seed, then measures the
+wall time, throughput and peak memory of find_most_common_color,
+find_sprites and create_sprite_labels_image. Results are written as one
+JSON object per line so runs of different versions can be compared. Run
+it from the module directory with the package installed:
+
+    python benchmarks/benchmark.py --sizes 64 1024 --output bench.jsonl
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+MODES = ('L', 'P', 'RGB', 'RGBA')
+SHAPES = ('rect', 'disc', 'blob', 'spiral', 'dots')
+SIZES = (64, 256, 1024, 2048, 4096, 8192)
+SPRITE_COUNTS = (16, 1024)
+
+
+def _spiral_mask(size):
+    """Draw a single square spiral sprite with one pixel wide gaps
+
+    Arguments:
+        size {int} -- Width and height of the sheet
+
+    Returns:
+        ndarray -- 2d boolean mask of the spiral
+    """
+    mask = np.zeros((size, size), dtype=bool)
+    top, left, bottom, right = 0, 0, size - 1, size - 1
+    while top <= bottom and left <= right:
+        mask[top, left:right + 1] = True
+        mask[top:bottom + 1, right] = True
+        mask[bottom, left:right + 1] = True
+        mask[top + 2:bottom + 1, left] = True
+        if top + 2 <= bottom:
+            mask[top + 2, left:left + 3] = True
+        top, left, bottom, right = top + 2, left + 2, bottom - 2, right - 2
+    return mask
+
+
+def make_labels(size, shape, sprites, seed=0):
+    """Draw the sprites of a synthetic sheet
+
+    Arguments:
+        size {int} -- Width and height of the sheet
+        shape {str} -- 'rect', 'disc' or 'blob' for sprites spread over a
+            grid, 'spiral' for one sprite winding over the whole sheet,
+            'dots' for single pixel sprites on every other row and column
+        sprites {int} -- Number of sprites of the grid shapes
+
+    Keyword Arguments:
+        seed {int} -- Seed of the random sprite sizes (default: {0})
+
+    Returns:
+        ndarray -- 2d uint8 array, 0 for the background, else the color
+            index, from 1 to 255, of the sprite
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.zeros((size, size), dtype=np.uint8)
+    if shape == 'spiral':
+        labels[_spiral_mask(size)] = 1
+        return labels
+    if shape == 'dots':
+        labels[::2, ::2] = rng.integers(1, 256, labels[::2, ::2].shape)
+        return labels
+    cells = max(1, int(np.ceil(np.sqrt(sprites))))
+    cell = size // cells
+    if cell < 3:
+        raise ValueError('Too many sprites for the sheet size')
+    rows, cols = np.mgrid[0:cell, 0:cell]
+    for index in range(min(sprites, cells * cells)):
+        top, left = divmod(index, cells)
+        top, left = top * cell, left * cell
+        radius = rng.uniform(0.25, 0.5) * (cell - 2)
+        center = (cell - 1) / 2
+        if shape == 'rect':
+            inside = (np.abs(rows - center) <= radius) & \
+                (np.abs(cols - center) <= radius * rng.uniform(0.5, 1))
+        elif shape == 'disc':
+            inside = (rows - center) ** 2 + (cols - center) ** 2 <= radius ** 2
+        else:
+            noise = rng.random((cell, cell)) < 0.8
+            inside = noise & ((rows - center) ** 2 + (cols - center) ** 2
+                              <= radius ** 2)
+        inside[[0, -1], :] = False
+        inside[:, [0, -1]] = False
+        color = rng.integers(1, 256)
+        labels[top:top + cell, left:left + cell][inside] = color
+    return labels
+
+
+def make_sheet(mode, size, shape, sprites, seed=0):
+    """Build a reproducible synthetic sprite sheet
+
+    Arguments:
+        mode {str} -- 'L', 'P', 'RGB' or 'RGBA'
+        size {int} -- Width and height of the sheet
+        shape {str} -- Shape of the sprites, see make_labels
+        sprites {int} -- Number of sprites of the grid shapes
+
+    Keyword Arguments:
+        seed {int} -- Seed of the sheet (default: {0})
+
+    Returns:
+        Image -- PIL Image object, the background is index or gray level 0,
+            black, or transparent for RGBA
+    """
+    labels = make_labels(size, shape, sprites, seed)
+    if mode in ('L', 'P'):
+        sheet = Image.fromarray(labels, 'L')
+        if mode == 'P':
+            sheet = sheet.convert('P')
+            sheet.putpalette(np.random.default_rng(seed).integers(
+                0, 256, 768, dtype=np.uint8).tobytes())
+        return sheet
+    palette = np.random.default_rng(seed).integers(0, 256, (256, 4),
+                                                   dtype=np.uint8)
+    palette[:, 3] = 255
+    palette[0] = 0
+    pixels = palette[labels]
+    if mode == 'RGB':
+        pixels = pixels[..., :3]
+    return Image.fromarray(np.ascontiguousarray(pixels), mode)
+
+
+def measure(function, setup):
+    """Run a function twice, once timed and once with its allocations
+    traced, since tracing slows down the allocations
+
+    Arguments:
+        function {function} -- Function of the result of setup
+        setup {function} -- Function without arguments preparing a run,
+            called before each one and not measured
+
+    Returns:
+        tuple -- Result of the timed run, its wall time in seconds and the
+            peak allocation of the traced run in bytes
+    """
+    argument = setup()
+    start = time.perf_counter()
+    result = function(argument)
+    seconds = time.perf_counter() - start
+    argument = setup()
+    tracemalloc.start()
+    try:
+        function(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_scenario(mode, size, shape, sprites, seed=0, **options):
+    """Measure every detection stage on one synthetic sheet
+
+    Arguments:
+        mode {str} -- Mode of the sheet
+        size {int} -- Width and height of the sheet
+        shape {str} -- Shape of the sprites
+        sprites {int} -- Number of sprites of the grid shapes
+
+    Keyword Arguments:
+        seed {int} -- Seed of the sheet (default: {0})
+        options -- Keyword arguments of SpriteSheet.find_sprites
+
+    Returns:
+        list -- One record per stage
+    """
+    sheet = make_sheet(mode, size, shape, sprites, seed)
+    background = 0 if mode in ('L', 'P') else \
+        None if mode == 'RGBA' else (0, 0, 0)
+
+    def new_sheet():
+        return SpriteSheet(sheet, background_color=background)
+
+    def detected_sheet():
+        spritesheet = new_sheet()
+        spritesheet.find_sprites(**options)
+        return spritesheet
+
+    # The detection is memoized, so every labeling run gets a new sheet
+    # and the rendering runs only measure the rendering.
+    stages = [
+        ('background', lambda: sheet, SpriteSheet.find_most_common_color),
+        ('labeling', new_sheet,
+         lambda spritesheet: spritesheet.find_sprites(as_array=True,
+                                                      **options)),
+        ('rendering', detected_sheet,
+         lambda spritesheet: spritesheet.create_sprite_labels_image(
+             seed=seed, **options)),
+    ]
+    records = []
+    found = None
+    for stage, setup, function in stages:
+        result, seconds, peak = measure(function, setup)
+        if stage == 'labeling':
+            found = len(result[0])
+        records.append({
+            'mode': mode, 'size': size, 'shape': shape, 'sprites': sprites,
+            'seed': seed, 'options': options, 'stage': stage,
+            'seconds': seconds,
+            'megapixels_per_second': size * size / 1e6 / max(seconds, 1e-9),
+            'peak_bytes': peak, 'sprites_found': found})
+    return records
+
+
+def main(argv=None):
+    """Run the benchmark suite
+
+    Keyword Arguments:
+        argv {list} -- Command line arguments (default: {None})
+
+    Returns:
+        int -- Exit status
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark sprite detection on synthetic sheets.')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--shapes', nargs='+', default=SHAPES,
+                        choices=SHAPES)
+    parser.add_argument('--sprites', nargs='+', type=int,
+                        default=SPRITE_COUNTS,
+                        help='sprite counts of the grid shapes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--tile-size', type=int, default=None)
+    parser.add_argument('--output', default=None,
+                        help='JSON lines file of the results (default: '
+                             'standard output)')
+    args = parser.parse_args(argv)
+    options = {}
+    if args.workers:
+        options['workers'] = args.workers
+    if args.tile_size:
+        options['tile_size'] = args.tile_size
+    output = open(args.output, 'w') if args.output else sys.stdout
+    environment = {'python': platform.python_version(),
+                   'numpy': np.__version__, 'machine': platform.machine()}
+    try:
+        for mode in args.modes:
+            for size in args.sizes:
+                for shape in args.shapes:
+                    counts = args.sprites if shape in ('rect', 'disc',
+                                                       'blob') else [None]
+                    for sprites in counts:
+                        try:
+                            records = run_scenario(mode, size, shape, sprites,
+                                                   args.seed, **options)
+                        except ValueError as e:
+                            print('skip {} {} {} {}: {}'.format(
+                                mode, size, shape, sprites, e),
+                                file=sys.stderr)
+                            continue
+                        for record in records:
+                            record.update(environment)
+                            output.write(json.dumps(record) + '\n')
+                            print('{mode:4} {size:5} {shape:6} {stage:10} '
+                                  '{seconds:9.3f}s {megapixels_per_second:9.2f}'
+                                  ' MP/s {peak_bytes:>12} B'.format(**record),
+                                  file=sys.stderr)
+                        output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
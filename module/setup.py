@@ -13,10 +13,13 @@ setuptools.setup(
     long_description=long_description,
     url="https://github.com/intek-training-jsc/sprite-detection-longlamduc.git",
     packages=setuptools.find_packages(),
+    entry_points={
+        'console_scripts': ['spriteutil=spriteutil_final.batch:main'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.9',
 )
\ No newline at end of file
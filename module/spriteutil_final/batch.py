@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import json
+import os
+import sys
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tga', '.tif',
+                    '.tiff', '.webp')
+
+
+def _sprite_box(sprite):
+    """Get the bounding box information of a sprite
+
+    Arguments:
+        sprite {Sprite} -- Sprite object
+
+    Returns:
+        dict -- Label, corners, area and centroid of the sprite
+    """
+    return {'label': sprite.label,
+            'top_left': list(sprite.top_left),
+            'bottom_right': list(sprite.bottom_right),
+            'area': sprite.area,
+            'centroid': list(sprite.centroid)}
+
+
+def _output_names(paths):
+    """Name the results of sprite sheets uniquely
+
+    A result is named after the path of its sheet relative to the directory
+    holding all the sheets, without extension, or with it when two sheets
+    differ only by their extension.
+
+    Arguments:
+        paths {list} -- Paths of the sprite sheets
+
+    Raises:
+        ValueError: Two sheets would write the same results
+
+    Returns:
+        list -- Relative names of the results, one per path
+    """
+    if not paths:
+        return []
+    paths = [os.path.abspath(path) for path in paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = [os.path.relpath(path, root) for path in paths]
+    stems = [os.path.splitext(name)[0] for name in names]
+    counts = {}
+    for stem in stems:
+        counts[os.path.normcase(stem)] = \
+            counts.get(os.path.normcase(stem), 0) + 1
+    names = [stem if counts[os.path.normcase(stem)] == 1 else name
+             for stem, name in zip(stems, names)]
+    seen = {}
+    for path, name in zip(paths, names):
+        other = seen.setdefault(os.path.normcase(name), path)
+        if other != path:
+            raise ValueError('{} and {} would write the same results'.format(
+                other, path))
+    return names
+
+
+def _detect_file(path, output_name, masks, options):
+    """Detect the sprites of one sheet and write its results
+
+    This runs in a worker process, so errors are returned instead of raised.
+
+    Arguments:
+        path {str} -- Path of the sprite sheet
+        output_name {str} -- Path of the results without suffix, nothing is
+            written if not defined
+        masks {bool} -- Also write the sprite label mask image
+        options {dict} -- Keyword arguments of SpriteSheet.find_sprites
+
+    Returns:
+        tuple -- Path, dictionary of sprites or None, error message or None
+    """
+    try:
+        sheet = SpriteSheet(path)
+        sprites, _ = sheet.find_sprites(as_array=True, **options)
+        if output_name:
+            os.makedirs(os.path.dirname(output_name), exist_ok=True)
+            with open(output_name + '.json', 'w') as fd:
+                json.dump([_sprite_box(sprite) for sprite in sprites.values()],
+                          fd)
+            if masks:
+                mask = sheet.create_sprite_labels_image(**options)
+                mask.save(output_name + '_mask.png')
+        return (path, sprites, None)
+    except Exception as e:
+        return (path, None, '{}: {}'.format(type(e).__name__, e))
+
+
+def detect_many(paths, workers=None, output_dir=None, masks=True, **options):
+    """Detect the sprites of many sheets in a process pool
+
+    Results are yielded as soon as each sheet is done, so they do not come
+    in the order of paths. A failing sheet does not stop the others, even
+    one killing its worker process: the pool is started again and the
+    sheets which were running are run again one at a time, so only the
+    sheet killing its worker is reported as failed. At most one sheet per
+    worker is submitted at once, so memory does not grow with the number of
+    sheets.
+
+    Arguments:
+        paths {list} -- Paths of the sprite sheets
+
+    Keyword Arguments:
+        workers {int} -- Number of worker processes, the number of CPUs if
+            not defined (default: {None})
+        output_dir {str} -- Directory where the bounding boxes, as
+            <name>.json, and the mask images, as <name>_mask.png, are
+            written; name is the path of the sheet relative to the directory
+            holding all the sheets (default: {None})
+        masks {bool} -- Also write the mask images (default: {True})
+        options -- Keyword arguments of SpriteSheet.find_sprites
+
+    Raises:
+        ValueError: Two sheets would write the same results
+
+    Returns:
+        generator -- Tuples of path, dictionary of sprites or None, error
+            message or None
+    """
+    paths = list(paths)
+    names = [None] * len(paths)
+    if output_dir:
+        names = [os.path.join(output_dir, name)
+                 for name in _output_names(paths)]
+        os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    waiting = deque(zip(paths, names))
+    # Sheets which were running when a worker died, one of them killed it.
+    suspects = deque()
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while waiting or suspects or running:
+            isolated = any(alone for _, _, alone in running.values())
+            if suspects and not running:
+                path, name = suspects.popleft()
+                running[executor.submit(_detect_file, path, name, masks,
+                                        options)] = (path, name, True)
+            elif not suspects and not isolated:
+                while waiting and len(running) < workers:
+                    path, name = waiting.popleft()
+                    running[executor.submit(_detect_file, path, name, masks,
+                                            options)] = (path, name, False)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                path, name, alone = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    if not alone:
+                        suspects.append((path, name))
+                        continue
+                    result = (path, None, '{}: {}'.format(type(e).__name__,
+                                                          e))
+                except Exception as e:
+                    result = (path, None, '{}: {}'.format(type(e).__name__,
+                                                          e))
+                yield result
+            if broken:
+                # Every sheet still running failed with the pool.
+                suspects.extend((path, name)
+                                for path, name, _ in running.values())
+                running.clear()
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _find_images(paths):
+    """List the image files of paths, looking inside directories
+
+    Arguments:
+        paths {list} -- Paths of image files or directories
+
+    Returns:
+        list -- Paths of image files
+    """
+    images = []
+    for path in paths:
+        if not os.path.isdir(path):
+            images.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            images.extend(os.path.join(root, name) for name in sorted(files)
+                          if name.lower().endswith(IMAGE_EXTENSIONS))
+    return images
+
+
+def main(argv=None):
+    """Run the spriteutil command line
+
+    Keyword Arguments:
+        argv {list} -- Command line arguments (default: {None})
+
+    Returns:
+        int -- Exit status, 1 if any sheet failed
+    """
+    parser = argparse.ArgumentParser(
+        prog='spriteutil',
+        description='Detect the sprites of sprite sheets.')
+    parser.add_argument('paths', nargs='+',
+                        help='sprite sheets or directories of sprite sheets')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory of the results (default: .)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    parser.add_argument('--min-size', type=int, default=1,
+                        help='minimum number of pixels of a sprite')
+    parser.add_argument('--tolerance', type=int, default=0,
+                        help='largest color difference of a background pixel')
+    parser.add_argument('--connectivity', type=int, choices=(4, 8),
+                        default=4, help='pixel connectivity of a sprite')
+    parser.add_argument('--no-mask', action='store_true',
+                        help='do not write the mask images')
+    args = parser.parse_args(argv)
+    images = _find_images(args.paths)
+    try:
+        _output_names(images)
+    except ValueError as e:
+        parser.error(str(e))
+    failed = 0
+    for path, sprites, error in detect_many(
+            images, workers=args.workers,
+            output_dir=args.output_dir, masks=not args.no_mask,
+            min_size=args.min_size, tolerance=args.tolerance,
+            connectivity=args.connectivity):
+        if error:
+            failed += 1
+            print('{}: FAILED {}'.format(path, error), file=sys.stderr)
+        else:
+            print('{}: {} sprites'.format(path, len(sprites)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+# Number of pixels hashed at once, this bounds the copies of huge sheets.
+HASH_CHUNK_PIXELS = 1 << 22
+
+# Suffix of the results being written, which eviction leaves alone.
+TEMPORARY_SUFFIX = '.tmp'
+
+
+class DetectionCache():
+    """Persistent cache of detection results, keyed by the image content
+
+    Every result is a compressed NumPy archive named after a hash of the
+    pixels and of the detection parameters. Reading an entry marks it as
+    recently used, and the least recently used entries are deleted when the
+    cache grows over its size limit.
+    """
+    def __init__(self, directory, max_bytes=1 << 30):
+        """
+        Arguments:
+            directory {str} -- Directory of the cache files
+
+        Keyword Arguments:
+            max_bytes {int} -- Size limit of the cache (default: {1 GiB})
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    @property
+    def max_bytes(self):
+        return self.__max_bytes
+
+    @staticmethod
+    def key(image, options):
+        """Hash the pixels and palette of an image and detection parameters
+
+        Arguments:
+            image {Image} -- PIL Image object
+            options {dict} -- Parameters which change the detection result
+
+        Returns:
+            str -- Hexadecimal digest
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        # The colors of a P image, thus its background, are in the palette.
+        palette = image.getpalette() if image.mode == 'P' else None
+        digest.update(repr((image.mode, image.size, palette,
+                            sorted(options.items()))).encode())
+        step = max(1, HASH_CHUNK_PIXELS // max(image.width, 1))
+        for top in range(0, image.height, step):
+            band = image.crop((0, top, image.width,
+                               min(top + step, image.height)))
+            digest.update(np.ascontiguousarray(np.asarray(band)).data)
+        return digest.hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.__directory, key + '.npz')
+
+    def load(self, key):
+        """Read a detection result
+
+        Arguments:
+            key {str} -- Key of the result
+
+        Returns:
+            tuple -- label_map ndarray and dictionary of region properties,
+                None if the key is not cached
+        """
+        path = self.__path(key)
+        try:
+            with np.load(path) as data:
+                label_map = data['label_map']
+                regions = {name: data[name] for name in data.files
+                           if name != 'label_map'}
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process since it was read.
+            pass
+        return label_map, regions
+
+    def save(self, key, label_map, regions):
+        """Write a detection result, then evict the least recently used ones
+
+        Arguments:
+            key {str} -- Key of the result
+            label_map {ndarray} -- Label map of the sprites
+            regions {dict} -- Region properties of the label map
+        """
+        fd, path = tempfile.mkstemp(suffix=TEMPORARY_SUFFIX,
+                                    dir=self.__directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.savez_compressed(file, label_map=label_map, **regions)
+            os.replace(path, self.__path(key))
+        except BaseException:
+            os.remove(path)
+            raise
+        self.__evict()
+
+    def __evict(self):
+        """Delete the least recently used results over the size limit"""
+        entries = []
+        for entry in os.scandir(self.__directory):
+            if entry.name.endswith('.npz') and entry.is_file():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.__max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Delete all the cached results"""
+        for entry in os.scandir(self.__directory):
+            if entry.name.endswith('.npz') and entry.is_file():
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import contextlib
+import logging
+import time
+import tracemalloc
+
+
+logger = logging.getLogger('spriteutil_final')
+
+# Callbacks of the active instrument() blocks.
+_callbacks = []
+
+
+@contextlib.contextmanager
+def instrument(callback=None, memory=False):
+    """Record every detection stage run inside the block
+
+    A record is a dictionary of the 'stage' name ('decode', 'background',
+    'labeling', 'regions', 'grouping', 'sprites' or 'rendering'), its wall
+    time in 'seconds', the number of 'pixels' it processed and its
+    'peak_bytes' allocation, which is None unless memory is set or
+    tracemalloc is already tracing.
+
+    Arguments:
+        callback {function} -- Called with each record, the records are
+            collected in the list given by the block if not defined
+            (default: {None})
+        memory {bool} -- Trace the allocations with tracemalloc to measure
+            the peak allocation of each stage, which slows the stages down
+            (default: {False})
+
+    Returns:
+        list -- Records of the stages, empty if there is a callback
+    """
+    records = []
+    callback = callback or records.append
+    _callbacks.append(callback)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield records
+    finally:
+        _callbacks.remove(callback)
+        if started:
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def stage(name, pixels):
+    """Measure one detection stage
+
+    Nothing is measured when no instrument() block is active and the
+    spriteutil_final logger does not log debug messages.
+
+    Arguments:
+        name {str} -- Name of the stage
+        pixels {int} -- Number of pixels the stage processes
+    """
+    if not _callbacks and not logger.isEnabledFor(logging.DEBUG):
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield
+    record = {'stage': name, 'seconds': time.perf_counter() - start,
+              'pixels': pixels,
+              'peak_bytes': tracemalloc.get_traced_memory()[1]
+              if tracing else None}
+    logger.debug('%s: %.6f s, %d pixels, peak %s bytes', name,
+                 record['seconds'], pixels, record['peak_bytes'])
+    for callback in list(_callbacks):
+        callback(dict(record))
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import asyncio
+import base64
+import hashlib
+import io
+import itertools
+import json
+import os
+
+import numpy as np
+
+from spriteutil_final.batch import _sprite_box
+from spriteutil_final.instrumentation import logger
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+# Largest request line read by the socket server.
+MAX_REQUEST_BYTES = 1 << 28
+
+# Options of find_sprites a socket request may set; the others choose
+# files and processes of the server.
+REQUEST_OPTIONS = ('min_size', 'tolerance', 'connectivity')
+
+
+class ServiceBusy(RuntimeError):
+    """Raised when a DetectionService has as many requests waiting for a
+    slot as it can queue"""
+
+
+def _release(loop, slots, future):
+    """Release the slot of a detection once its worker is done with it
+
+    This is called in a thread of the process pool.
+
+    Arguments:
+        loop {asyncio.AbstractEventLoop} -- Event loop of the service
+        slots {asyncio.Semaphore} -- Slots of the service
+        future {concurrent.futures.Future} -- Finished detection
+    """
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        # The event loop is closed, nothing waits for the slot anymore.
+        pass
+
+
+def _detect_image(image, background_color, options):
+    """Detect the sprites of one image
+
+    This runs in a worker process of DetectionService.
+
+    Arguments:
+        image {str or bytes or Image or ndarray} -- Path, content of an image
+            file, PIL Image object or pixels
+        background_color {tuple or int} -- Color of the image background
+        options {dict} -- Keyword arguments of SpriteSheet.find_sprites
+
+    Returns:
+        tuple -- Sprites and label_map ndarray
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    sheet = SpriteSheet(image, background_color)
+    return sheet.find_sprites(as_array=True, **options)
+
+
+def _request_key(image, background_color, options):
+    """Hash a detection request, identical requests have the same key
+
+    This runs in a thread of the event loop, hashing releases the GIL.
+
+    Arguments:
+        image {str or bytes or Image or ndarray} -- Image of the request
+        background_color {tuple or int} -- Color of the image background
+        options {dict} -- Keyword arguments of SpriteSheet.find_sprites
+
+    Returns:
+        str -- Hexadecimal digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((background_color, sorted(options.items()))).encode())
+    if isinstance(image, (str, os.PathLike)):
+        stat = os.stat(image)
+        digest.update(repr((os.path.abspath(image), stat.st_size,
+                            stat.st_mtime_ns)).encode())
+    elif isinstance(image, (bytes, bytearray)):
+        digest.update(image)
+    elif isinstance(image, np.ndarray):
+        digest.update(repr((image.shape, image.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(image).data)
+    else:
+        palette = image.getpalette() if image.mode == 'P' else None
+        digest.update(repr((image.mode, image.size, palette)).encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class DetectionService():
+    """Asynchronous front end of sprite detection for asyncio programs
+
+    Detections run in a bounded process pool, so the event loop is never
+    blocked. At most max_pending detections are admitted at once, until
+    their worker is done with them, and at most max_queued requests wait
+    for a slot, the others are rejected; identical requests in flight share
+    one detection.
+
+    Use it as an async context manager, or call close() when done.
+    """
+    def __init__(self, workers=None, max_pending=None, max_queued=None,
+                 timeout=None):
+        """
+        Keyword Arguments:
+            workers {int} -- Number of worker processes, the number of CPUs
+                if not defined (default: {None})
+            max_pending {int} -- Number of detections admitted at once, twice
+                the number of workers if not defined (default: {None})
+            max_queued {int} -- Number of requests waiting for a slot,
+                max_pending if not defined (default: {None})
+            timeout {float} -- Default time limit of a request in seconds,
+                including its wait for a slot (default: {None})
+        """
+        workers = workers or os.cpu_count() or 1
+        self.__pool = ProcessPoolExecutor(workers)
+        self.__max_pending = max_pending or 2 * workers
+        self.__max_queued = self.__max_pending if max_queued is None \
+            else max_queued
+        # The semaphore is made in the event loop which uses it.
+        self.__slots = None
+        self.__queued = 0
+        self.__timeout = timeout
+        self.__in_flight = {}
+        self.__ids = itertools.count(1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def in_flight(self):
+        return len(self.__in_flight)
+
+    async def close(self):
+        """Stop the worker processes, cancelling the queued detections"""
+        for task, _ in list(self.__in_flight.values()):
+            task.cancel()
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.__pool.shutdown(cancel_futures=True))
+
+    async def detect(self, image, background_color=None, timeout=None,
+                     **options):
+        """Detect the sprites of an image without blocking the event loop
+
+        Cancelling the caller, or its timeout, abandons the request; the
+        detection itself is cancelled unless it already runs or another
+        caller shares it.
+
+        Arguments:
+            image {str or bytes or Image or ndarray} -- Path, content of an
+                image file, PIL Image object or pixels
+
+        Keyword Arguments:
+            background_color {tuple or int} -- Color of the image background,
+                the most common color if not defined (default: {None})
+            timeout {float} -- Time limit in seconds, the default of the
+                service if not defined (default: {None})
+            options -- Keyword arguments of SpriteSheet.find_sprites
+
+        Raises:
+            ServiceBusy: Too many requests wait for a slot
+            asyncio.TimeoutError: The request took longer than timeout
+
+        Returns:
+            tuple -- Sprites and label_map ndarray, as returned by
+                SpriteSheet.find_sprites
+        """
+        options.pop('as_array', None)
+        # Hashing reads every pixel, which would block the event loop.
+        key = await asyncio.get_running_loop().run_in_executor(
+            None, _request_key, image, background_color, options)
+        entry = self.__in_flight.get(key)
+        if entry is None:
+            request = next(self.__ids)
+            task = asyncio.ensure_future(self.__run(request, image,
+                                                    background_color,
+                                                    options))
+            entry = [task, 0]
+            self.__in_flight[key] = entry
+            task.add_done_callback(lambda _: self.__in_flight.pop(key, None))
+        else:
+            logger.debug('Sharing an identical request in flight')
+        entry[1] += 1
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(entry[0]),
+                self.__timeout if timeout is None else timeout)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not entry[0].done():
+                entry[0].cancel()
+
+    async def __run(self, request, image, background_color, options):
+        """Run one detection in the pool once a slot is free
+
+        Arguments:
+            request {int} -- Number of the request, for logging
+            image {str or bytes or Image or ndarray} -- Image of the request
+            background_color {tuple or int} -- Color of the image background
+            options {dict} -- Keyword arguments of SpriteSheet.find_sprites
+
+        Raises:
+            ServiceBusy: Too many requests wait for a slot
+
+        Returns:
+            tuple -- Sprites and label_map ndarray
+        """
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.__max_pending)
+        if self.__slots.locked() and self.__queued >= self.__max_queued:
+            raise ServiceBusy('{} requests are waiting for a slot'.format(
+                self.__queued))
+        self.__queued += 1
+        try:
+            await self.__slots.acquire()
+        finally:
+            self.__queued -= 1
+        try:
+            future = self.__pool.submit(_detect_image, image,
+                                        background_color, options)
+        except BaseException:
+            self.__slots.release()
+            raise
+        # An abandoned detection keeps running in its worker, so its slot
+        # is only released once the worker is done with it.
+        future.add_done_callback(partial(
+            _release, asyncio.get_running_loop(), self.__slots))
+        logger.debug('Request %d: detecting', request)
+        result = await asyncio.wrap_future(future)
+        logger.debug('Request %d: %d sprites', request, len(result[0]))
+        return result
+
+    async def serve(self, path=None, host='127.0.0.1', port=0):
+        """Serve detection requests on a local socket
+
+        Every request is one line of JSON, with the 'path' of an image file
+        or its base64 'data', an optional 'background_color', 'timeout' and
+        'options' of find_sprites among REQUEST_OPTIONS, and an optional
+        'id'. Every response is one line of JSON with the same 'id', and
+        either the 'sprites' as boxes or an 'error' message, 'Busy' when the
+        queue of the service is full. Requests of one connection are
+        answered in order, connections run concurrently.
+
+        Keyword Arguments:
+            path {str} -- Path of a Unix socket, TCP is used if not defined
+                (default: {None})
+            host {str} -- Host of the TCP socket (default: {'127.0.0.1'})
+            port {int} -- Port of the TCP socket, any free port if 0
+                (default: {0})
+
+        Returns:
+            asyncio.AbstractServer -- Started server
+        """
+        if path:
+            return await asyncio.start_unix_server(
+                self.__handle, path, limit=MAX_REQUEST_BYTES)
+        return await asyncio.start_server(self.__handle, host, port,
+                                          limit=MAX_REQUEST_BYTES)
+
+    async def __handle(self, reader, writer):
+        """Answer the requests of one connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self.__answer(line)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # The peer left, or sent a line longer than MAX_REQUEST_BYTES.
+            pass
+        finally:
+            writer.close()
+
+    async def __answer(self, line):
+        """Answer one request line of the socket server
+
+        Arguments:
+            line {bytes} -- JSON request
+
+        Returns:
+            dict -- JSON response
+        """
+        request = {}
+        try:
+            request = json.loads(line)
+            options = dict(request.get('options') or {})
+            unknown = sorted(set(options) - set(REQUEST_OPTIONS))
+            if unknown:
+                raise ValueError('Unknown options: {}'.format(
+                    ', '.join(unknown)))
+            image = request.get('path') or \
+                base64.b64decode(request['data'])
+            background_color = request.get('background_color')
+            if isinstance(background_color, list):
+                background_color = tuple(background_color)
+            sprites, _ = await self.detect(
+                image, background_color, request.get('timeout'), **options)
+            return {'id': request.get('id'),
+                    'sprites': [_sprite_box(sprite)
+                                for sprite in sprites.values()]}
+        except asyncio.TimeoutError:
+            return {'id': request.get('id'), 'error': 'Timeout'}
+        except ServiceBusy:
+            return {'id': request.get('id'), 'error': 'Busy'}
+        except Exception as e:
+            return {'id': request.get('id') if isinstance(request, dict)
+                    else None, 'error': '{}: {}'.format(type(e).__name__, e)}
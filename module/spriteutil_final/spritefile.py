@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+import json
+import os
+
+import numpy as np
+
+from spriteutil_final.spriteutil import REGION_CHUNK_PIXELS, SPRITE_DTYPE, \
+    SpriteCollection, _label_dtype
+
+
+MAGIC = b'SPRITES\0'
+
+VERSION = 1
+
+# Run of one label in a row of the label map, background runs are not
+# stored.
+RUN_DTYPE = np.dtype([('start', '<u4'), ('length', '<u4'), ('label', '<u4')])
+
+# Sprite table of the file, little-endian whatever the machine.
+RECORD_DTYPE = SPRITE_DTYPE.newbyteorder('<')
+
+# Sections start at multiples of this, so they can be mapped as arrays.
+ALIGNMENT = 8
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _encode_rows(label_map):
+    """Run-length encode the sprite pixels of a label map, row by row
+
+    Arguments:
+        label_map {ndarray} -- 2d array of labels, background is 0
+
+    Returns:
+        tuple -- RUN_DTYPE array of the runs, in raster order, and uint64
+            array of the index of the first run of each row, followed by
+            the number of runs
+    """
+    height, width = label_map.shape
+    step = max(1, REGION_CHUNK_PIXELS // max(width, 1))
+    runs = []
+    counts = np.zeros(height, dtype=np.uint64)
+    for top in range(0, height, step):
+        block = np.asarray(label_map[top:top + step])
+        change = np.ones(block.shape, dtype=bool)
+        change[:, 1:] = block[:, 1:] != block[:, :-1]
+        rows, starts = np.nonzero(change)
+        labels = block[rows, starts]
+        # A run ends at the start of the next one or at the end of its row.
+        ends = np.append(starts[1:], width)
+        ends[np.append(rows[1:] != rows[:-1], True)] = width
+        kept = labels != 0
+        band = np.empty(int(kept.sum()), dtype=RUN_DTYPE)
+        band['start'] = starts[kept]
+        band['length'] = (ends - starts)[kept]
+        band['label'] = labels[kept]
+        runs.append(band)
+        counts[top:top + len(block)] = np.bincount(rows[kept],
+                                                   minlength=len(block))
+    offsets = np.zeros(height + 1, dtype=np.uint64)
+    np.cumsum(counts, out=offsets[1:])
+    runs = np.concatenate(runs) if runs else np.empty(0, dtype=RUN_DTYPE)
+    return runs, offsets
+
+
+def write_sprite_file(file, sprites, label_map, options=None):
+    """Write detection results in the sprite file format
+
+    The file holds a JSON header, the sprite table as SPRITE_DTYPE records,
+    the index of the first run of every row and the runs of sprite pixels of
+    the label map. Every section is aligned, so SpriteFile maps them
+    without parsing.
+
+    Arguments:
+        file {str or file} -- Path or binary file object
+        sprites {SpriteCollection} -- Sprites found by find_sprites
+        label_map {ndarray} -- Label map of the sprites
+
+    Keyword Arguments:
+        options {dict} -- Parameters of the detection, stored in the header
+            (default: {None})
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'wb') as stream:
+            write_sprite_file(stream, sprites, label_map, options)
+        return
+    label_map = np.asarray(label_map)
+    height, width = label_map.shape
+    runs, offsets = _encode_rows(label_map)
+    records = np.asarray(sprites.records, dtype=RECORD_DTYPE)
+    options = dict(options or {})
+    if isinstance(options.get('background_color'), tuple):
+        options['background_color'] = list(options['background_color'])
+    header = json.dumps({'version': VERSION, 'height': height,
+                         'width': width, 'sprites': len(records),
+                         'runs': len(runs), 'options': options}).encode()
+    start = _align(len(MAGIC) + 4 + len(header))
+    sections = [records.tobytes(), offsets.astype('<u8').tobytes(),
+                runs.tobytes()]
+    file.write(MAGIC + np.uint32(len(header)).astype('<u4').tobytes() +
+               header)
+    position = len(MAGIC) + 4 + len(header)
+    for section in sections:
+        file.write(b'\0' * (start - position))
+        file.write(section)
+        position = start + len(section)
+        start = _align(position)
+
+
+class SpriteFile():
+    """Detection results read from the sprite file format
+
+    Files are memory-mapped, so opening one only parses its header: the
+    sprites and the runs of the rows are read when they are used.
+    """
+    def __init__(self, source):
+        """
+        Arguments:
+            source {str or buffer} -- Path of the file, or bytes holding it
+
+        Raises:
+            ValueError: Not a sprite file, or of an unknown version
+        """
+        if isinstance(source, (str, os.PathLike)):
+            data = np.memmap(source, dtype=np.uint8, mode='r')
+        else:
+            data = np.frombuffer(source, dtype=np.uint8)
+        if data[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError('This is not a sprite file')
+        size = int(data[len(MAGIC):len(MAGIC) + 4].view('<u4')[0])
+        position = len(MAGIC) + 4
+        header = json.loads(data[position:position + size].tobytes())
+        if header['version'] != VERSION:
+            raise ValueError('Unknown sprite file version: {}'.format(
+                header['version']))
+        position += size
+        sections = []
+        for dtype, count in [(RECORD_DTYPE, header['sprites']),
+                             (np.dtype('<u8'), header['height'] + 1),
+                             (RUN_DTYPE, header['runs'])]:
+            start = _align(position)
+            position = start + dtype.itemsize * count
+            sections.append(data[start:position].view(dtype))
+        records, self.__offsets, self.__runs = sections
+        if records.dtype != SPRITE_DTYPE:
+            records = records.astype(SPRITE_DTYPE)
+        options = header['options']
+        if isinstance(options.get('background_color'), list):
+            options['background_color'] = tuple(options['background_color'])
+        self.__header = header
+        self.__sprites = SpriteCollection(records)
+
+    @property
+    def shape(self):
+        return (self.__header['height'], self.__header['width'])
+
+    @property
+    def options(self):
+        return dict(self.__header['options'])
+
+    @property
+    def sprites(self):
+        return self.__sprites
+
+    def runs(self, row):
+        """Get the runs of sprite pixels of a row
+
+        Arguments:
+            row {int} -- Index of the row
+
+        Returns:
+            ndarray -- RUN_DTYPE array of the runs, by column
+        """
+        return self.__runs[int(self.__offsets[row]):
+                           int(self.__offsets[row + 1])]
+
+    def labels(self, top=0, bottom=None, left=0, right=None):
+        """Decode a rectangle of the label map
+
+        Only the runs of its rows are read.
+
+        Keyword Arguments:
+            top {int} -- First row (default: {0})
+            bottom {int} -- Row after the last one, the image height if not
+                defined (default: {None})
+            left {int} -- First column (default: {0})
+            right {int} -- Column after the last one, the image width if
+                not defined (default: {None})
+
+        Returns:
+            ndarray -- 2d uint16 or uint32 array of labels, background is 0
+        """
+        height, width = self.shape
+        bottom = height if bottom is None else bottom
+        right = width if right is None else right
+        runs = self.__runs[int(self.__offsets[top]):
+                           int(self.__offsets[bottom])]
+        rows = np.repeat(np.arange(bottom - top),
+                         np.diff(self.__offsets[top:bottom + 1]).astype(
+                             np.int64))
+        starts = np.clip(runs['start'].astype(np.int64), left, right) - left
+        ends = np.clip(runs['start'].astype(np.int64) + runs['length'],
+                       left, right) - left
+        inside = starts < ends
+        rows, starts, ends = rows[inside], starts[inside], ends[inside]
+        labels = runs['label'][inside].astype(np.int64)
+        # Runs do not overlap, so the running sum of +label at their start
+        # and -label at their end is the label of every pixel.
+        columns = right - left
+        deltas = np.zeros((bottom - top) * columns + 1, dtype=np.int64)
+        deltas[rows * columns + starts] = labels
+        deltas[rows * columns + ends] -= labels
+        dtype = _label_dtype(max(len(self.__sprites),
+                                 int(labels.max(initial=0))))
+        return np.cumsum(deltas[:-1]).astype(dtype).reshape(
+            bottom - top, columns)
+
+    @property
+    def label_map(self):
+        return self.labels()
+
+    def sprite_mask(self, sprite):
+        """Get the mask of a sprite inside its bounding box
+
+        Arguments:
+            sprite {Sprite} -- Sprite of this file
+
+        Returns:
+            ndarray -- 2d boolean array, True for the pixels of the sprite
+        """
+        (top, left), (bottom, right) = sprite.top_left, sprite.bottom_right
+        return self.labels(top, bottom + 1, left, right + 1) == sprite.label
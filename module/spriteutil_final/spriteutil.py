@@ -1,16 +1,1039 @@
 #!/usr/bin/python3
 
-from PIL import Image
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+import mmap
 import numpy as np
-import random
 import sys
+import tempfile
+
+from spriteutil_final.instrumentation import logger, stage
+
+
+ENGINES = ('numpy', 'python')
+
+# Record of a sprite in a SpriteCollection, the coordinates are the ones of
+# Sprite: top and bottom are x, left and right are y.
+SPRITE_DTYPE = np.dtype([
+    ('label', np.uint32), ('top', np.int32), ('left', np.int32),
+    ('bottom', np.int32), ('right', np.int32), ('area', np.int64),
+    ('centroid_row', np.float64), ('centroid_col', np.float64)])
+
+# Bounding boxes covering more grid cells than this are not put in the grid
+# index of a SpriteCollection but checked by every query.
+GRID_LARGE_CELLS = 64
+
+# Number of label map pixels scanned at once by the region properties stage,
+# this bounds its temporary arrays on huge sheets.
+REGION_CHUNK_PIXELS = 1 << 22
+
+# Image modes of in-memory pixels, by their number of bands.
+ARRAY_MODES = {1: ('L', 'P'), 2: ('LA',), 3: ('RGB',), 4: ('RGBA',)}
+
+# Types of the pixels given to SpriteSheet as in-memory pixels.
+BUFFER_TYPES = (np.ndarray, memoryview, bytes, bytearray, mmap.mmap)
+
+
+def _mask_equal(lst_pixel, background):
+    """Mask kernel of single band pixels, compared with the background"""
+    return lst_pixel != background
+
+
+def _mask_lookup(lst_pixel, lookup):
+    """Mask kernel of uint8 single band pixels, looked up in a table of the
+    256 values, True for the sprite ones"""
+    return lookup[lst_pixel]
+
+
+def _mask_alpha(lst_pixel, tolerance):
+    """Mask kernel of LA and RGBA pixels without background color, which
+    tests the alpha band alone"""
+    return lst_pixel[..., -1] > tolerance
+
+
+def _mask_packed(lst_pixel, background):
+    """Mask kernel of LA and RGBA pixels, viewed as one uint16 or uint32
+    value per pixel and compared with the packed background"""
+    try:
+        packed = lst_pixel.view(background.dtype)[..., 0]
+    except ValueError:
+        # The bands of a pixel are not contiguous, the view is impossible.
+        return _mask_bands(lst_pixel, background.view(np.uint8))
+    return packed != background
+
+
+def _mask_bands(lst_pixel, background):
+    """Mask kernel of multi-band pixels, compared with the background band
+    by band"""
+    mask = lst_pixel[..., 0] != background[0]
+    for band in range(1, len(background)):
+        mask |= lst_pixel[..., band] != background[band]
+    return mask
+
+
+def _mask_band_lookups(lst_pixel, lookups):
+    """Mask kernel of uint8 multi-band pixels, with one table of the 256
+    values per band, True for the values near the background"""
+    # Tables of the background values avoid widening the whole pixel array
+    # to compute differences.
+    near = lookups[0][lst_pixel[..., 0]]
+    for band in range(1, len(lookups)):
+        near &= lookups[band][lst_pixel[..., band]]
+    return ~near
+
+
+def _mask_difference(lst_pixel, background, tolerance):
+    """Mask kernel of the other modes, whose pixels are not uint8"""
+    difference = np.abs(lst_pixel.astype(np.int64) - background)
+    if difference.ndim == 3:
+        difference = difference.max(axis=-1)
+    return difference > tolerance
+
+
+def _mask_kernel(mode, background, tolerance=0, palette=None):
+    """Choose the foreground mask kernel of an image, once for all its pixels
+
+    A pixel is background when none of its bands differ from the background
+    color by more than tolerance. Without background color, the pixels of an
+    LA or RGBA image are background when their alpha is at most tolerance.
+    'P' images are tested on their palette indices, never expanded to RGB.
+
+    Arguments:
+        mode {str} -- Mode of the image
+        background {tuple or int} -- Color of the image background, None
+            for the transparent pixels of an LA or RGBA image
+
+    Keyword Arguments:
+        tolerance {int} -- Largest difference of a band from the background
+            color, or largest alpha, of a background pixel (default: {0})
+        palette {list} -- Palette of a 'P' mode image, whose pixels are
+            compared by their palette color when tolerance is set
+            (default: {None})
+
+    Returns:
+        function -- Picklable function of an ndarray of pixels giving the
+            2d boolean array, True for sprite pixels
+    """
+    values = np.arange(256)
+    if mode in ('LA', 'RGBA') and not background:
+        return partial(_mask_alpha, tolerance=tolerance)
+    if mode == 'P' and tolerance:
+        colors = np.zeros((256, 3), dtype=np.int32)
+        palette = np.asarray(palette or [], dtype=np.int32)[:768]
+        colors.flat[:len(palette)] = palette
+        near = np.abs(colors - colors[background]).max(axis=1) <= tolerance
+        return partial(_mask_lookup, lookup=~near)
+    if mode == 'L' and tolerance:
+        return partial(_mask_lookup,
+                       lookup=np.abs(values - background) > tolerance)
+    if mode in ('LA', 'RGB', 'RGBA'):
+        bands = np.asarray(background, dtype=np.uint8)
+        if tolerance:
+            return partial(_mask_band_lookups, lookups=np.abs(
+                values - bands[:, np.newaxis].astype(int)) <= tolerance)
+        if mode == 'RGB':
+            return partial(_mask_bands, background=bands)
+        return partial(_mask_packed, background=bands.view(
+            np.uint16 if mode == 'LA' else np.uint32))
+    if not tolerance:
+        return partial(_mask_equal, background=background)
+    return partial(_mask_difference, background=background,
+                   tolerance=tolerance)
+
+
+def _read_only(array):
+    """Get a read-only view of an array
+
+    Arguments:
+        array {ndarray} -- Array kept by a SpriteSheet
+
+    Returns:
+        ndarray -- View of the array which cannot be written
+    """
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def _label_dtype(count):
+    """Get the smallest unsigned integer type able to store a label
+
+    Arguments:
+        count {int} -- Number of labels
+
+    Returns:
+        type -- np.uint16 or np.uint32
+    """
+    if count <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def _find_runs(mask):
+    """Find the horizontal runs of foreground pixels of a mask
+
+    Arguments:
+        mask {ndarray} -- 2d boolean array, True for foreground pixels
+
+    Returns:
+        tuple -- Arrays (rows, starts, ends) of the runs in raster order,
+            ends are exclusive
+    """
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+
+def _overlapping_runs(rows, starts, ends, width, connectivity=4):
+    """Find every pair of runs which touch each other in consecutive rows
+
+    Arguments:
+        rows {ndarray} -- Row index of each run
+        starts {ndarray} -- First column of each run
+        ends {ndarray} -- Column after the last one of each run
+        width {int} -- Width of the mask the runs were found in
+
+    Keyword Arguments:
+        connectivity {int} -- 4 if runs only touch through a side, 8 if
+            they also touch through a corner (default: {4})
+
+    Returns:
+        tuple -- Arrays (lower, upper) of run indices, the run upper lies
+            in the row just above the run lower
+    """
+    # Runs are disjoint and sorted in raster order, so their start and end
+    # keys both grow monotonically and can be binary searched at once.
+    stride = width + 2
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    above = (rows - 1) * stride
+    corner = 1 if connectivity == 8 else 0
+    first = np.searchsorted(end_keys, above + starts - corner, side='right')
+    last = np.searchsorted(start_keys, above + ends + corner, side='left')
+    counts = np.maximum(last - first, 0)
+    lower = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.cumsum(counts) - counts
+    upper = np.repeat(first - offsets, counts) + np.arange(counts.sum())
+    return lower, upper
+
+
+def _union_pairs(count, lower, upper):
+    """Merge connected items, such as runs, with a vectorized union-find
+
+    Every root is hooked onto the smallest root it is connected to, then the
+    parent array is fully compressed by pointer jumping, until all the pairs
+    share the same root.
+
+    Arguments:
+        count {int} -- Number of items
+        lower {ndarray} -- Index of the first item of each connected pair
+        upper {ndarray} -- Index of the second item of each connected pair
+
+    Returns:
+        ndarray -- Root of each item, which is the smallest item index of its
+            component
+    """
+    parent = np.arange(count)
+    while True:
+        lower_root, upper_root = parent[lower], parent[upper]
+        pending = lower_root != upper_root
+        if not pending.any():
+            return parent
+        lower_root, upper_root = lower_root[pending], upper_root[pending]
+        np.minimum.at(parent, np.maximum(lower_root, upper_root),
+                      np.minimum(lower_root, upper_root))
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+
+
+def _label_mask(mask, connectivity=4):
+    """Label the 4 or 8-connected components of a foreground mask
+
+    Components are numbered from 1 in the raster order of their first pixel,
+    exactly like the flood fill scan of SpriteSheet.find_sprites does.
+
+    Arguments:
+        mask {ndarray} -- 2d boolean array, True for foreground pixels
+
+    Keyword Arguments:
+        connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
+
+    Returns:
+        tuple -- Label map as a 2d uint16 or uint32 ndarray, background is 0,
+            and the number of labels
+    """
+    height, width = mask.shape
+    rows, starts, ends = _find_runs(mask)
+    lower, upper = _overlapping_runs(rows, starts, ends, width, connectivity)
+    roots = _union_pairs(len(rows), lower, upper)
+    # Roots are the first run of their component in raster order.
+    roots, labels = np.unique(roots, return_inverse=True)
+    labels = labels.reshape(-1) + 1
+    label_map = np.zeros(height * width, dtype=_label_dtype(len(roots)))
+    label_map[mask.reshape(-1)] = np.repeat(labels, ends - starts)
+    return label_map.reshape(height, width), len(roots)
+
+
+def _seam_pairs(here, there, connectivity=4):
+    """Find the pairs of labels which touch each other across a seam
+
+    Arguments:
+        here {ndarray} -- Labels along one side of the seam
+        there {ndarray} -- Labels along the other side of the seam, with one
+            more label at each end: there[i + 1] faces here[i]
+
+    Keyword Arguments:
+        connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
+
+    Returns:
+        tuple -- Arrays (lower, upper) of touching labels of here and there
+    """
+    lower, upper = [], []
+    for shift in ((0,) if connectivity == 4 else (-1, 0, 1)):
+        facing = there[1 + shift:1 + shift + len(here)]
+        touching = (here > 0) & (facing > 0)
+        lower.append(here[touching].astype(np.int64))
+        upper.append(facing[touching].astype(np.int64))
+    return np.concatenate(lower), np.concatenate(upper)
+
+
+def _label_tiled(mask_tile, shape, tile_size, min_size=1, label_file=None,
+                 connectivity=4):
+    """Label the components of a foreground mask tile by tile
+
+    Each tile is labeled on its own into a provisional memory-mapped map,
+    components crossing a tile border are merged through an equivalence
+    table, then a second pass writes the final labels, numbered in the same
+    raster order as _label_mask, into another memory-mapped map.
+
+    Arguments:
+        mask_tile {function} -- Get the 2d boolean foreground mask of the
+            tile (top, left, bottom, right), bottom and right are exclusive
+        shape {tuple} -- Height and width of the whole mask
+        tile_size {int} -- Width and height of the tiles
+
+    Keyword Arguments:
+        min_size {int} -- Minimum area of a component to keep it
+            (default: {1})
+        label_file {str} -- Path of the file which stores the label map, a
+            temporary file is used if not defined (default: {None})
+        connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
+
+    Returns:
+        tuple -- Label map as a 2d uint16 or uint32 memmap, background is 0,
+            and the number of labels
+    """
+    height, width = shape
+    tiles = [(top, left, min(top + tile_size, height),
+              min(left + tile_size, width))
+             for top in range(0, height, tile_size)
+             for left in range(0, width, tile_size)]
+    provisional = np.memmap(tempfile.TemporaryFile(), dtype=np.uint32,
+                            mode='w+', shape=shape)
+    first_pixels = [np.zeros(1, dtype=np.int64)]
+    areas = [np.zeros(1, dtype=np.int64)]
+    lower, upper = [], []
+    offset = 0
+    for top, left, bottom, right in tiles:
+        labels, count = _label_mask(mask_tile(top, left, bottom, right),
+                                    connectivity)
+        rows, cols = np.nonzero(labels)
+        tile_labels = labels[rows, cols]
+        _, first = np.unique(tile_labels, return_index=True)
+        first_pixels.append((rows[first] + top) * width + cols[first] + left)
+        areas.append(np.bincount(tile_labels, minlength=count + 1)[1:])
+        tile = labels.astype(np.uint32)
+        tile[rows, cols] += offset
+        provisional[top:bottom, left:right] = tile
+        if top > 0:
+            there = np.zeros(right - left + 2, dtype=np.uint32)
+            first, last = max(left - 1, 0), min(right + 1, width)
+            there[first - left + 1:last - left + 1] = \
+                provisional[top - 1, first:last]
+            pairs = _seam_pairs(tile[0], there, connectivity)
+            lower.append(pairs[0])
+            upper.append(pairs[1])
+        if left > 0:
+            there = np.zeros(bottom - top + 2, dtype=np.uint32)
+            first = max(top - 1, 0)
+            there[first - top + 1:bottom - top + 1] = \
+                provisional[first:bottom, left - 1]
+            pairs = _seam_pairs(tile[:, 0], there, connectivity)
+            lower.append(pairs[0])
+            upper.append(pairs[1])
+        offset += count
+    parent = _union_pairs(offset + 1,
+                          np.concatenate([np.zeros(0, np.int64)] + lower),
+                          np.concatenate([np.zeros(0, np.int64)] + upper))
+    first_pixel = np.full(offset + 1, height * width, dtype=np.int64)
+    np.minimum.at(first_pixel, parent, np.concatenate(first_pixels))
+    area = np.bincount(parent, np.concatenate(areas), minlength=offset + 1)
+    kept = (parent == np.arange(offset + 1)) & (area >= min_size)
+    kept[0] = False
+    kept = np.nonzero(kept)[0]
+    kept = kept[np.argsort(first_pixel[kept], kind='stable')]
+    count = len(kept)
+    lookup = np.zeros(offset + 1, dtype=_label_dtype(count))
+    lookup[kept] = np.arange(1, count + 1)
+    lookup = lookup[parent]
+    label_map = np.memmap(label_file or tempfile.TemporaryFile(),
+                          dtype=_label_dtype(count), mode='w+', shape=shape)
+    for top, left, bottom, right in tiles:
+        label_map[top:bottom, left:right] = \
+            lookup[provisional[top:bottom, left:right]]
+    label_map.flush()
+    return label_map, count
+
+
+def _stream_regions(mask_rows, shape, min_size=1, connectivity=4):
+    """Find the region properties of the components of a foreground mask,
+    band of rows by band of rows, without any label map
+
+    Only the components reaching the last row of a band stay open, with the
+    labels of that row; the others are complete and only their properties
+    are kept. Memory is bounded by the band and the number of components.
+
+    Arguments:
+        mask_rows {function} -- Get the 2d boolean foreground mask of the
+            rows from top to bottom, bottom is exclusive
+        shape {tuple} -- Height and width of the whole mask
+
+    Keyword Arguments:
+        min_size {int} -- Minimum area of a component to keep it
+            (default: {1})
+        connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
+
+    Returns:
+        dict -- Region properties, as _region_properties gives them for the
+            label map of _label_mask
+    """
+    height, width = shape
+    names = ('area', 'top', 'left', 'bottom', 'right', 'row_sum', 'col_sum',
+             'first')
+    lowest = ('top', 'left', 'first')
+    opened = {name: np.zeros(0, dtype=np.int64) for name in names}
+    closed = {name: [] for name in names}
+    carry = np.zeros(width, dtype=np.int64)
+    step = max(1, REGION_CHUNK_PIXELS // max(width, 1))
+    for top in range(0, height, step):
+        labels, count = _label_mask(mask_rows(top, min(top + step, height)),
+                                    connectivity)
+        band = _region_properties(labels, count)
+        area = band['area'][1:]
+        band = {'area': area, 'top': band['top'][1:] + top,
+                'left': band['left'][1:], 'bottom': band['bottom'][1:] + top,
+                'right': band['right'][1:],
+                'row_sum': np.rint(band['centroid_row'][1:] * area).astype(
+                    np.int64) + top * area,
+                'col_sum': np.rint(band['centroid_col'][1:] * area).astype(
+                    np.int64),
+                'first': band['first'][1:] + top * width}
+        # Items are the open components, then the labels of the band.
+        known = len(opened['area'])
+        lower, upper = _seam_pairs(labels[0].astype(np.int64),
+                                   np.concatenate([[0], carry, [0]]),
+                                   connectivity)
+        parent = _union_pairs(known + count, known + lower - 1, upper - 1)
+        stats = {}
+        for name in names:
+            values = np.concatenate([opened[name], band[name]])
+            if name == 'area' or name.endswith('_sum'):
+                stats[name] = np.bincount(parent, values,
+                                          minlength=len(parent)).astype(
+                                              np.int64)
+            else:
+                merged = values.copy()
+                (np.minimum if name in lowest else np.maximum).at(
+                    merged, parent, values)
+                stats[name] = merged
+        last = labels[-1].astype(np.int64)
+        live = np.unique(parent[known + last[last > 0] - 1])
+        done = np.nonzero(parent == np.arange(len(parent)))[0]
+        done = done[~np.isin(done, live)]
+        for name in names:
+            closed[name].append(stats[name][done])
+            opened[name] = stats[name][live]
+        carry = np.zeros(width, dtype=np.int64)
+        carry[last > 0] = np.searchsorted(
+            live, parent[known + last[last > 0] - 1]) + 1
+    for name in names:
+        closed[name].append(opened[name])
+    stats = {name: np.concatenate(values) for name, values in closed.items()}
+    kept = stats['area'] >= min_size
+    order = np.argsort(stats['first'][kept], kind='stable')
+    stats = {name: np.concatenate([[0], values[kept][order]])
+             for name, values in stats.items()}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['centroid_row'] = stats.pop('row_sum') / stats['area']
+        stats['centroid_col'] = stats.pop('col_sum') / stats['area']
+    return stats
+
+
+def _label_band(pixel_name, label_name, shape, dtype, mask_kernel,
+                connectivity, top, bottom, lookup=None):
+    """Label one horizontal band of an image held in shared memory
+
+    This runs in a worker process. The first call labels the band on its
+    own, the second one, given a lookup table, turns these band labels into
+    the final labels in place.
+
+    Arguments:
+        pixel_name {str} -- Name of the shared memory of the pixels
+        label_name {str} -- Name of the shared memory of the uint32 labels
+        shape {tuple} -- Shape of the pixel array
+        dtype {str} -- Type of the pixel array
+        mask_kernel {function} -- Foreground mask kernel of the image
+        connectivity {int} -- 4 or 8 neighbour connectivity
+        top {int} -- First row of the band
+        bottom {int} -- Row after the last one of the band
+
+    Keyword Arguments:
+        lookup {ndarray} -- Final label of each band label (default: {None})
+
+    Returns:
+        int -- Number of labels of the band
+    """
+    label_memory = shared_memory.SharedMemory(name=label_name)
+    try:
+        labels = np.ndarray(shape[:2], dtype=np.uint32,
+                            buffer=label_memory.buf)[top:bottom]
+        if lookup is not None:
+            labels[:] = lookup[labels]
+            return len(lookup) - 1
+        pixel_memory = shared_memory.SharedMemory(name=pixel_name)
+        try:
+            lst_pixel = np.ndarray(shape, dtype=dtype,
+                                   buffer=pixel_memory.buf)[top:bottom]
+            band, count = _label_mask(mask_kernel(lst_pixel), connectivity)
+            labels[:] = band
+            del lst_pixel
+        finally:
+            pixel_memory.close()
+        del labels
+        return count
+    finally:
+        label_memory.close()
+
+
+def _label_parallel(lst_pixel, mask_kernel, workers, connectivity=4):
+    """Label the components of an image by bands in a process pool
+
+    The pixels and the labels live in shared memory. Every band is labeled
+    by a worker, components crossing the border between two bands are
+    merged, then the workers write the final labels, which are identical to
+    the ones of _label_mask.
+
+    Arguments:
+        lst_pixel {ndarray} -- Pixels of the image
+        mask_kernel {function} -- Foreground mask kernel of the image
+        workers {int} -- Number of worker processes
+
+    Keyword Arguments:
+        connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
+
+    Returns:
+        tuple -- Label map as a 2d uint16 or uint32 ndarray, background is 0,
+            and the number of labels
+    """
+    height, width = lst_pixel.shape[:2]
+    bounds = np.linspace(0, height, min(workers, height) + 1).astype(int)
+    bands = list(zip(bounds[:-1], bounds[1:]))
+    pixel_memory = shared_memory.SharedMemory(
+        create=True, size=max(lst_pixel.nbytes, 1))
+    label_memory = shared_memory.SharedMemory(
+        create=True, size=max(height * width * 4, 1))
+    try:
+        pixels = np.ndarray(lst_pixel.shape, dtype=lst_pixel.dtype,
+                            buffer=pixel_memory.buf)
+        pixels[:] = lst_pixel
+        labels = np.ndarray((height, width), dtype=np.uint32,
+                            buffer=label_memory.buf)
+        task = (pixel_memory.name, label_memory.name, lst_pixel.shape,
+                lst_pixel.dtype.str, mask_kernel, connectivity)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(executor.map(_label_band, *zip(
+                *[task + band for band in bands])))
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            lower, upper = [], []
+            for (top, _), offset, previous in zip(bands[1:], offsets[1:],
+                                                  offsets[:-1]):
+                here, there = _seam_pairs(labels[top],
+                                          np.pad(labels[top - 1], 1),
+                                          connectivity)
+                lower.append(here + offset)
+                upper.append(there + previous)
+            total = int(offsets[-1])
+            parent = _union_pairs(
+                total + 1, np.concatenate([np.zeros(0, np.int64)] + lower),
+                np.concatenate([np.zeros(0, np.int64)] + upper))
+            # Bands and the labels inside a band are both in raster order,
+            # so the smallest band label of a component is its first pixel.
+            roots, lookup = np.unique(parent, return_inverse=True)
+            count = len(roots) - 1
+            lookup = lookup.reshape(-1).astype(np.uint32)
+            list(executor.map(_label_band, *zip(
+                *[task + band + (np.concatenate(
+                    [[0], lookup[offset + 1:offset + band_count + 1]]),)
+                  for band, offset, band_count in zip(bands, offsets,
+                                                      counts)])))
+        label_map = labels.astype(_label_dtype(count))
+        del pixels, labels
+    finally:
+        pixel_memory.close()
+        pixel_memory.unlink()
+        label_memory.close()
+        label_memory.unlink()
+    return label_map, count
+
+
+def _region_properties(label_map, count):
+    """Measure every labeled region in a single pass over the label map
+
+    Arguments:
+        label_map {ndarray} -- 2d array of labels, background is 0
+        count {int} -- Number of labels
+
+    Returns:
+        dict -- Arrays indexed by label: 'area', 'top', 'left', 'bottom',
+            'right', 'centroid_row', 'centroid_col' and 'first', the raster
+            index of the first pixel
+    """
+    height, width = label_map.shape
+    area = np.zeros(count + 1, dtype=np.int64)
+    first = np.full(count + 1, height * width, dtype=np.int64)
+    row_sum = np.zeros(count + 1)
+    col_sum = np.zeros(count + 1)
+    top = np.full(count + 1, height, dtype=np.int64)
+    left = np.full(count + 1, width, dtype=np.int64)
+    bottom = np.full(count + 1, -1, dtype=np.int64)
+    right = np.full(count + 1, -1, dtype=np.int64)
+    step = max(1, REGION_CHUNK_PIXELS // max(width, 1))
+    for first_row in range(0, height, step):
+        block = np.asarray(label_map[first_row:first_row + step])
+        rows, cols = np.nonzero(block)
+        labels = block[rows, cols]
+        rows += first_row
+        area += np.bincount(labels, minlength=count + 1)
+        row_sum += np.bincount(labels, rows, minlength=count + 1)
+        col_sum += np.bincount(labels, cols, minlength=count + 1)
+        np.minimum.at(top, labels, rows)
+        np.minimum.at(left, labels, cols)
+        np.maximum.at(bottom, labels, rows)
+        np.maximum.at(right, labels, cols)
+        np.minimum.at(first, labels, rows * width + cols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid_row = row_sum / area
+        centroid_col = col_sum / area
+    return {'area': area, 'top': top, 'left': left, 'bottom': bottom,
+            'right': right, 'centroid_row': centroid_row,
+            'centroid_col': centroid_col, 'first': first}
+
+
+def _update_labels(label_map, regions, dirty, mask_window, min_size=1,
+                   connectivity=4):
+    """Label again the components around an edited rectangle
+
+    Only the components touching the rectangle, or its one pixel border, can
+    change: they are erased and the window covering them and the rectangle
+    is labeled again, so merges and splits are found. The result is the
+    same as labeling the whole edited image.
+
+    Arguments:
+        label_map {ndarray} -- Label map before the edit
+        regions {dict} -- Region properties of the label map
+        dirty {tuple} -- Edited rectangle (x1, y1, x2, y2), inclusive, in
+            the coordinates of Sprite.top_left
+        mask_window {function} -- Get the 2d boolean foreground mask of the
+            edited image in the window (top, left, bottom, right), bottom
+            and right are exclusive
+
+    Keyword Arguments:
+        min_size {int} -- Minimum area of a component to keep it
+            (default: {1})
+        connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
+
+    Returns:
+        tuple -- Label map as a 2d uint16 or uint32 ndarray and its region
+            properties
+    """
+    height, width = label_map.shape
+    x1, y1, x2, y2 = dirty
+    if 'first' not in regions:
+        regions = _region_properties(label_map, len(regions['area']) - 1)
+    stale = np.zeros(len(regions['area']), dtype=bool)
+    stale[np.asarray(label_map[max(x1 - 1, 0):x2 + 2,
+                               max(y1 - 1, 0):y2 + 2])] = True
+    stale[0] = True
+    affected = np.nonzero(stale)[0][1:]
+    top = min(x1, int(regions['top'][affected].min(initial=x1)))
+    left = min(y1, int(regions['left'][affected].min(initial=y1)))
+    bottom = max(x2, int(regions['bottom'][affected].max(initial=x2))) + 1
+    right = max(y2, int(regions['right'][affected].max(initial=y2))) + 1
+    margin = 8
+    while True:
+        block = np.asarray(label_map[top:bottom, left:right])
+        mask = mask_window(top, left, bottom, right) & stale[block]
+        if min_size == 1 or (top, left, bottom, right) == \
+                (0, 0, height, width):
+            break
+        # Components smaller than min_size were erased from the label map,
+        # they may now join an edited component and go past the window.
+        outer = (max(top - 1, 0), max(left - 1, 0), min(bottom + 1, height),
+                 min(right + 1, width))
+        erased = mask_window(*outer) & \
+            (np.asarray(label_map[outer[0]:outer[2], outer[1]:outer[3]]) == 0)
+        erased[top - outer[0]:bottom - outer[0],
+               left - outer[1]:right - outer[1]] = False
+        if not erased.any():
+            break
+        top, left = max(top - margin, 0), max(left - margin, 0)
+        bottom, right = min(bottom + margin, height), min(right + margin, width)
+        margin *= 2
+    local, count = _label_mask(mask, connectivity)
+    found = _region_properties(local, count)
+    for name, offset in [('top', top), ('bottom', top), ('centroid_row', top),
+                         ('left', left), ('right', left),
+                         ('centroid_col', left)]:
+        found[name] = found[name] + offset
+    rows, cols = np.divmod(found['first'], right - left)
+    found['first'] = (rows + top) * width + cols + left
+    kept = ~stale
+    new = found['area'] >= min_size
+    new[0] = False
+    combined = {name: np.concatenate([regions[name][kept], found[name][new]])
+                for name in regions}
+    order = np.argsort(combined['first'], kind='stable')
+    total = len(order)
+    rank = np.empty(total, dtype=np.int64)
+    rank[order] = np.arange(1, total + 1)
+    dtype = _label_dtype(total)
+    old_lookup = np.zeros(len(stale), dtype=dtype)
+    old_lookup[kept] = rank[:kept.sum()]
+    new_lookup = np.zeros(count + 1, dtype=dtype)
+    new_lookup[new] = rank[kept.sum():]
+    updated = old_lookup[label_map]
+    window = updated[top:bottom, left:right]
+    window[mask] = new_lookup[local[mask]]
+    regions = {name: np.concatenate([values[:1], combined[name][order]])
+               for name, values in regions.items()}
+    return updated, regions
+
+
+def _filter_regions(label_map, regions, min_size):
+    """Drop the regions smaller than min_size pixels and renumber the others
+
+    Arguments:
+        label_map {ndarray} -- 2d array of labels, background is 0
+        regions {dict} -- Region properties of the label map
+        min_size {int} -- Minimum area of a region to keep it
+
+    Returns:
+        tuple -- Label map and region properties without the dropped
+            regions, labels stay consecutive and keep their order
+    """
+    keep = regions['area'] >= min_size
+    keep[0] = True
+    if keep.all():
+        return label_map, regions
+    count = int(keep.sum()) - 1
+    lookup = np.zeros(len(keep), dtype=_label_dtype(count))
+    lookup[keep] = np.arange(count + 1)
+    label_map = lookup[label_map]
+    regions = {key: value[keep] for key, value in regions.items()}
+    return label_map, regions
+
+
+def _sprite_colors(count, mode, background, seed=None):
+    """Build the color table of a sprite label mask
+
+    Arguments:
+        count {int} -- Number of sprites
+        mode {str} -- 'RGB' or 'RGBA'
+        background {tuple} -- Color of the background, at index 0
+
+    Keyword Arguments:
+        seed {int} -- Seed of the random colors (default: {None})
+
+    Returns:
+        ndarray -- uint8 array of count + 1 colors, the sprite colors are
+            distinct and differ from the background
+    """
+    # Colors are drawn as packed 24-bit RGB values, skipping the background.
+    excluded = (background[0] << 16) | (background[1] << 8) | background[2]
+    choices = (1 << 24) - 1
+    packed = np.random.default_rng(seed).choice(choices, size=count,
+                                                replace=count > choices)
+    packed += packed >= excluded
+    colors = np.empty((count + 1, len(mode)), dtype=np.uint8)
+    colors[0] = background
+    colors[1:, 0] = packed >> 16
+    colors[1:, 1] = (packed >> 8) & 0xFF
+    colors[1:, 2] = packed & 0xFF
+    if mode == 'RGBA':
+        colors[1:, 3] = 255
+    return colors
+
+
+def _box_cells(first_row, first_col, last_row, last_col, columns):
+    """List the grid cells covered by boxes given in cell coordinates
+
+    Returns:
+        tuple -- Arrays of the index of the box and of the cell, one entry
+            per covered cell
+    """
+    cols = last_col - first_col + 1
+    cells = (last_row - first_row + 1) * cols
+    position = np.arange(cells.sum()) - np.repeat(np.cumsum(cells) - cells,
+                                                  cells)
+    cols = np.repeat(cols, cells)
+    cell_ids = (np.repeat(first_row, cells) + position // cols) * columns + \
+        np.repeat(first_col, cells) + position % cols
+    return np.repeat(np.arange(len(cells)), cells), cell_ids
+
+
+def _box_outlines(top, left, bottom, right):
+    """List the pixels of the outlines of bounding boxes
+
+    Arguments:
+        top {ndarray} -- First row of the boxes
+        left {ndarray} -- First column of the boxes
+        bottom {ndarray} -- Last row of the boxes
+        right {ndarray} -- Last column of the boxes
+
+    Returns:
+        tuple -- int64 arrays of the row, the column and the index of the
+            box of every outline pixel
+    """
+    top, left = top.astype(np.int64), left.astype(np.int64)
+    bottom, right = bottom.astype(np.int64), right.astype(np.int64)
+    boxes = np.arange(len(top))
+    widths, heights = right - left + 1, bottom - top + 1
+    across = np.repeat(boxes, widths)
+    cols = np.repeat(left, widths) + np.arange(widths.sum()) - \
+        np.repeat(np.cumsum(widths) - widths, widths)
+    down = np.repeat(boxes, heights)
+    rows = np.repeat(top, heights) + np.arange(heights.sum()) - \
+        np.repeat(np.cumsum(heights) - heights, heights)
+    return (np.concatenate([top[across], bottom[across], rows, rows]),
+            np.concatenate([cols, cols, left[down], right[down]]),
+            np.concatenate([across, across, down, down]))
+
+
+def _close_boxes(top, left, bottom, right, gap):
+    """Find the pairs of bounding boxes separated by at most gap pixels
+
+    Boxes are hashed into a uniform grid, sized after most boxes, and only
+    boxes sharing a cell are compared. The few boxes covering many cells
+    are compared with all the others instead.
+
+    Arguments:
+        top {ndarray} -- First row of the boxes
+        left {ndarray} -- First column of the boxes
+        bottom {ndarray} -- Last row of the boxes
+        right {ndarray} -- Last column of the boxes
+        gap {int} -- Largest number of background rows and columns between
+            two close boxes
+
+    Returns:
+        tuple -- Arrays (lower, upper) of the indices of close boxes
+    """
+    reach = gap + 1
+    extent = np.maximum(bottom - top, right - left) + 1
+    cell = max(reach, int(np.percentile(extent, 90)) if len(extent) else 1)
+    columns = int(max(bottom.max(initial=0), right.max(initial=0))) // cell + 3
+    # Cell coordinates are shifted by one so the grown boxes stay positive.
+    first_row, first_col = top // cell + 1, left // cell + 1
+    last_row, last_col = bottom // cell + 1, right // cell + 1
+    large = (last_row - first_row + 1) * (last_col - first_col + 1) > \
+        GRID_LARGE_CELLS
+    small = np.nonzero(~large)[0]
+    boxes, cell_ids = _box_cells(first_row[small], first_col[small],
+                                 last_row[small], last_col[small], columns)
+    boxes = small[boxes]
+    order = np.argsort(cell_ids, kind='stable')
+    boxes, cell_ids = boxes[order], cell_ids[order]
+    # A box grown by reach, at most one cell, finds the boxes it touches in
+    # the cells around its own.
+    grown, grown_ids = _box_cells(
+        (top[small] - reach) // cell + 1, (left[small] - reach) // cell + 1,
+        (bottom[small] + reach) // cell + 1,
+        (right[small] + reach) // cell + 1, columns)
+    grown = small[grown]
+    starts = np.searchsorted(cell_ids, grown_ids)
+    counts = np.searchsorted(cell_ids, grown_ids, side='right') - starts
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                   counts)
+    lower = [np.repeat(grown, counts)]
+    upper = [boxes[np.repeat(starts, counts) + position]]
+    for box in np.nonzero(large)[0]:
+        lower.append(np.full(len(top), box))
+        upper.append(np.arange(len(top)))
+    lower, upper = np.concatenate(lower), np.concatenate(upper)
+    close = (lower != upper) & \
+        (top[upper] <= bottom[lower] + reach) & \
+        (top[lower] <= bottom[upper] + reach) & \
+        (left[upper] <= right[lower] + reach) & \
+        (left[lower] <= right[upper] + reach)
+    return lower[close], upper[close]
+
+
+def _group_regions(label_map, regions, gap):
+    """Merge the regions whose bounding boxes are close into one region
+
+    Close boxes are found with a grid hash and merged with a union-find, so
+    the cost grows about linearly with the number of regions.
+
+    Arguments:
+        label_map {ndarray} -- 2d array of labels, background is 0
+        regions {dict} -- Region properties of the label map
+        gap {int} -- Largest number of background rows and columns between
+            the bounding boxes of two merged regions
+
+    Returns:
+        tuple -- Label map and region properties of the groups, numbered in
+            the raster order of their first pixel
+    """
+    count = len(regions['area']) - 1
+    top, left = regions['top'][1:], regions['left'][1:]
+    bottom, right = regions['bottom'][1:], regions['right'][1:]
+    lower, upper = _close_boxes(top, left, bottom, right, gap)
+    # Labels are in raster order, so the smallest label of a group, its
+    # root, has the first pixel of the group.
+    parent = np.concatenate([[0], _union_pairs(count, lower, upper) + 1])
+    roots, groups = np.unique(parent, return_inverse=True)
+    groups = groups.reshape(-1)
+    total = len(roots) - 1
+    area = regions['area']
+    grouped = {'area': np.bincount(groups, area, minlength=total + 1).astype(
+        np.int64)}
+    for name in ('top', 'left', 'bottom', 'right', 'first'):
+        if name not in regions:
+            continue
+        values = regions[name][roots].copy()
+        (np.maximum if name in ('bottom', 'right') else np.minimum).at(
+            values, groups, regions[name])
+        grouped[name] = values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name in ('centroid_row', 'centroid_col'):
+            weights = np.nan_to_num(regions[name]) * area
+            grouped[name] = np.bincount(groups, weights,
+                                        minlength=total + 1) / \
+                grouped['area']
+    lookup = groups.astype(_label_dtype(total))
+    return lookup[label_map], grouped
+
+
+def _track_sprites(previous_map, previous_regions, previous_ids, label_map,
+                   regions, next_id):
+    """Give the sprites of a frame the identities of the previous frame
+
+    A sprite keeps the identity of the previous sprite with the same first
+    pixel, which is the case of all unchanged sprites; the others take the
+    identity of the free previous sprite they overlap most, or a new one.
+    Only the bounding boxes of these other sprites are compared.
+
+    Arguments:
+        previous_map {ndarray} -- Label map of the previous frame
+        previous_regions {dict} -- Region properties of the previous frame
+        previous_ids {ndarray} -- Identity of each previous label
+        label_map {ndarray} -- Label map of the frame
+        regions {dict} -- Region properties of the frame
+        next_id {int} -- First unused identity
+
+    Returns:
+        tuple -- int64 ndarray of the identity of each label, 0 for the
+            background, and the next unused identity
+    """
+    count = len(regions['first']) - 1
+    ids = np.zeros(count + 1, dtype=np.int64)
+    taken = np.zeros(len(previous_ids), dtype=bool)
+    taken[0] = True
+    previous_first = previous_regions['first'][1:]
+    index = np.searchsorted(previous_first, regions['first'][1:])
+    index = np.minimum(index, max(len(previous_first) - 1, 0))
+    same = np.zeros(count + 1, dtype=bool)
+    if len(previous_first):
+        same[1:] = previous_first[index] == regions['first'][1:]
+    ids[same] = previous_ids[index[same[1:]] + 1]
+    taken[index[same[1:]] + 1] = True
+    labels = np.nonzero(~same)[0][1:]
+    if len(labels):
+        top, left = regions['top'][labels].min(), regions['left'][labels].min()
+        bottom = regions['bottom'][labels].max() + 1
+        right = regions['right'][labels].max() + 1
+        here = np.asarray(label_map[top:bottom, left:right]).astype(np.int64)
+        there = np.asarray(previous_map[top:bottom, left:right]).astype(
+            np.int64)
+        free = (here > 0) & ~same[here] & ~taken[there]
+        pairs, overlaps = np.unique(here[free] * len(taken) + there[free],
+                                    return_counts=True)
+        for pair in pairs[np.argsort(-overlaps, kind='stable')].tolist():
+            label, previous = divmod(pair, len(taken))
+            if not ids[label] and not taken[previous]:
+                ids[label] = previous_ids[previous]
+                taken[previous] = True
+    fresh = np.nonzero(ids[1:] == 0)[0] + 1
+    ids[fresh] = np.arange(next_id, next_id + len(fresh))
+    return ids, next_id + len(fresh)
+
+
+def _convert_color(image, color, mode):
+    """Convert a color of an image to another mode
+
+    Arguments:
+        image {Image} -- PIL Image object, whose palette and transparency
+            are used
+        color {tuple or int} -- Color in the mode of the image
+        mode {str} -- Mode of the converted color
+
+    Returns:
+        tuple or int -- Converted color, None if color is None
+    """
+    from PIL import Image
+    if color is None:
+        return None
+    pixel = Image.new(image.mode, (1, 1), color)
+    if image.mode == 'P':
+        pixel.putpalette(image.getpalette())
+        if 'transparency' in image.info:
+            pixel.info['transparency'] = image.info['transparency']
+    return pixel.convert(mode).getpixel((0, 0))
+
+
+def _create_sprites(regions):
+    """Create the collection of sprites of all labeled regions
+
+    Arguments:
+        regions {dict} -- Region properties indexed by label
+
+    Returns:
+        SpriteCollection -- Sprites by label
+    """
+    count = len(regions['area']) - 1
+    records = np.empty(count, dtype=SPRITE_DTYPE)
+    records['label'] = np.arange(1, count + 1)
+    for name in SPRITE_DTYPE.names[1:]:
+        records[name] = regions[name][1:]
+    return SpriteCollection(records)
 
 
 class Sprite():
     """
         Create a sprite object wihth label and position
     """
-    def __init__(self, label, x1, y1, x2, y2):
+    __slots__ = ('__label', '__x1', '__y1', '__x2', '__y2', '__area',
+                 '__centroid')
+
+    def __init__(self, label, x1, y1, x2, y2, area=None, centroid=None):
         """
         Arguments:
             label {int} -- Sprite label
@@ -18,6 +1041,11 @@ class Sprite():
             y1 {int } -- top position of sprite
             x2 {int} -- right position of sprite
             y2 {int} -- bottom position of sprite
+
+        Keyword Arguments:
+            area {int} -- Number of pixels of the sprite (default: {None})
+            centroid {tuple} -- Mean (x, y) position of the sprite pixels
+                (default: {None})
         
         Raises:
             ValueError: Arguments is not type int
@@ -35,8 +1063,35 @@ class Sprite():
         self.__y1 = y1
         self.__x2 = x2
         self.__y2 = y2
-        self.__width = self.__x2 - self.__x1 + 1
-        self.__height = self.__y2 -  self.__y1 + 1
+        self.__area = area
+        self.__centroid = centroid
+
+    @classmethod
+    def _from_records(cls, records):
+        """Create the sprites of records of a SpriteCollection, which are
+        already valid
+
+        The records are converted to Python values at once, which is much
+        faster than reading them field by field.
+
+        Arguments:
+            records {ndarray} -- Structured array of SPRITE_DTYPE
+
+        Returns:
+            list -- Sprite objects, in the order of the records
+        """
+        sprites = []
+        for label, x1, y1, x2, y2, area, row, col in records.tolist():
+            sprite = cls.__new__(cls)
+            sprite.__label = label
+            sprite.__x1 = x1
+            sprite.__y1 = y1
+            sprite.__x2 = x2
+            sprite.__y2 = y2
+            sprite.__area = area
+            sprite.__centroid = (row, col)
+            sprites.append(sprite)
+        return sprites
 
     @property
     def label(self):
@@ -52,11 +1107,344 @@ class Sprite():
 
     @property
     def width(self) :
-        return self.__width
+        return self.__x2 - self.__x1 + 1
 
     @property
     def height(self):
-        return self.__height
+        return self.__y2 - self.__y1 + 1
+
+    @property
+    def area(self):
+        return self.__area
+
+    @property
+    def centroid(self):
+        return self.__centroid
+
+    @property
+    def slices(self):
+        """Get the slices of the sprite bounding box in a (row, col) array
+
+        Returns:
+            tuple -- Slices of the rows and of the columns
+        """
+        return (slice(self.__x1, self.__x2 + 1),
+                slice(self.__y1, self.__y2 + 1))
+
+
+class SpriteCollection(Mapping):
+    """Compact collection of sprites, stored as a NumPy structured array
+
+    It is a read-only mapping of labels to Sprite objects, which are only
+    created when they are accessed. A grid index of the bounding boxes,
+    built on the first query, answers point, rectangle and nearest sprite
+    queries. Coordinates are (x, y) like Sprite.top_left.
+    """
+    def __init__(self, records):
+        """
+        Arguments:
+            records {ndarray} -- Structured array of SPRITE_DTYPE, sorted by
+                label
+        """
+        self.__records = records
+        self.__grid = None
+
+    @property
+    def records(self):
+        return self.__records
+
+    def __len__(self):
+        return len(self.__records)
+
+    def __iter__(self):
+        return iter(self.__records['label'].tolist())
+
+    def __index(self, label):
+        labels = self.__records['label']
+        index = int(np.searchsorted(labels, label))
+        if index == len(labels) or labels[index] != label:
+            raise KeyError(label)
+        return index
+
+    def __getitem__(self, label):
+        index = self.__index(label)
+        return Sprite._from_records(self.__records[index:index + 1])[0]
+
+    def __contains__(self, label):
+        try:
+            self.__index(label)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def values(self):
+        """Get all the sprites, reading the records once
+
+        Returns:
+            list -- Sprite objects, in label order
+        """
+        return Sprite._from_records(self.__records)
+
+    def items(self):
+        """Get all the labels and sprites, reading the records once
+
+        Returns:
+            list -- Tuples of label and Sprite object, in label order
+        """
+        return list(zip(self.__records['label'].tolist(), self.values()))
+
+    def __sprites(self, indices):
+        """Create the sprites of some records, in label order
+
+        Arguments:
+            indices {ndarray} -- Indices of records
+
+        Returns:
+            list -- Sprite objects
+        """
+        return Sprite._from_records(self.__records[np.unique(indices)])
+
+    def __build_grid(self):
+        """Index the bounding boxes in a uniform grid
+
+        Cells hold the indices of the boxes they intersect, in a compressed
+        (offsets, indices) layout. Boxes covering many cells are kept in a
+        separate list that every query checks, so one huge sprite does not
+        fill the whole grid.
+        """
+        records = self.__records
+        count = len(records)
+        extent = max(int(records['bottom'].max(initial=0)),
+                     int(records['right'].max(initial=0))) + 1
+        cell = max(1, int(np.ceil(extent / max(np.sqrt(count), 1))))
+        columns = extent // cell + 1
+        first_row, first_col = records['top'] // cell, records['left'] // cell
+        rows = records['bottom'] // cell - first_row + 1
+        cols = records['right'] // cell - first_col + 1
+        cells = rows * cols
+        large = cells > GRID_LARGE_CELLS
+        boxes = np.nonzero(~large)[0]
+        cells, cols = cells[boxes], cols[boxes]
+        position = np.arange(cells.sum()) - np.repeat(np.cumsum(cells) - cells,
+                                                      cells)
+        cell_ids = (np.repeat(first_row[boxes], cells) + position //
+                    np.repeat(cols, cells)) * columns + \
+            np.repeat(first_col[boxes], cells) + position % np.repeat(cols,
+                                                                      cells)
+        boxes = np.repeat(boxes, cells)
+        order = np.argsort(cell_ids, kind='stable')
+        offsets = np.searchsorted(cell_ids[order],
+                                  np.arange(columns * columns + 1))
+        self.__grid = (cell, columns, offsets, boxes[order],
+                       np.nonzero(large)[0])
+
+    def __candidates(self, first_row, first_col, last_row, last_col):
+        """Get the boxes intersecting a range of grid cells
+
+        The range may reach past the grid, which only covers the extent of
+        the boxes.
+
+        Returns:
+            ndarray -- Indices of records, with duplicates
+        """
+        _, columns, offsets, boxes, large = self.__grid
+        first_row, first_col = max(first_row, 0), max(first_col, 0)
+        last_row, last_col = min(last_row, columns - 1), \
+            min(last_col, columns - 1)
+        if first_row > last_row or first_col > last_col:
+            return large
+        found = [large]
+        for row in range(first_row, last_row + 1):
+            start = row * columns
+            found.append(boxes[offsets[start + first_col]:
+                               offsets[start + last_col + 1]])
+        return np.concatenate(found)
+
+    def __distances(self, indices, x, y):
+        """Get the distances from a point to some bounding boxes
+
+        Returns:
+            ndarray -- Euclidean distances, 0 inside a box
+        """
+        records = self.__records[indices]
+        dx = np.maximum(np.maximum(records['top'] - x, x - records['bottom']),
+                        0)
+        dy = np.maximum(np.maximum(records['left'] - y, y - records['right']),
+                        0)
+        return np.hypot(dx, dy)
+
+    def at(self, x, y):
+        """Find the sprites whose bounding box contains a pixel
+
+        Arguments:
+            x {int} -- First coordinate of the pixel, as in Sprite.top_left
+            y {int} -- Second coordinate of the pixel
+
+        Returns:
+            list -- Sprite objects, in label order
+        """
+        return self.in_rect(x, y, x, y)
+
+    def in_rect(self, x1, y1, x2, y2):
+        """Find the sprites whose bounding box intersects a rectangle
+
+        Arguments:
+            x1 {int} -- First coordinate of the top left corner
+            y1 {int} -- Second coordinate of the top left corner
+            x2 {int} -- First coordinate of the bottom right corner
+            y2 {int} -- Second coordinate of the bottom right corner
+
+        Returns:
+            list -- Sprite objects, in label order
+        """
+        if not len(self):
+            return []
+        if self.__grid is None:
+            self.__build_grid()
+        cell = self.__grid[0]
+        indices = self.__candidates(x1 // cell, y1 // cell, x2 // cell,
+                                    y2 // cell)
+        records = self.__records[indices]
+        inside = (records['top'] <= x2) & (records['bottom'] >= x1) & \
+            (records['left'] <= y2) & (records['right'] >= y1)
+        return self.__sprites(indices[inside])
+
+    def nearest(self, x, y, count=1):
+        """Find the sprites whose bounding box is nearest to a pixel
+
+        The grid is searched in growing rings of cells around the pixel,
+        until no unvisited cell can hold a nearer box.
+
+        Arguments:
+            x {int} -- First coordinate of the pixel, as in Sprite.top_left
+            y {int} -- Second coordinate of the pixel
+
+        Keyword Arguments:
+            count {int} -- Number of sprites (default: {1})
+
+        Returns:
+            list -- Sprite objects, nearest first, ties in label order
+        """
+        count = min(count, len(self))
+        if not count:
+            return []
+        if self.__grid is None:
+            self.__build_grid()
+        cell, columns = self.__grid[:2]
+        row, col = x // cell, y // cell
+        # Rings closer than the grid are empty, start at its nearest cell.
+        radius = max(0, -row, -col, row - columns + 1, col - columns + 1)
+        while True:
+            indices = np.unique(self.__candidates(
+                row - radius, col - radius, row + radius, col + radius))
+            distances = self.__distances(indices, x, y)
+            # Unvisited cells are at least radius cells away from the pixel.
+            searched = radius * cell
+            everything = row - radius <= 0 and col - radius <= 0 and \
+                row + radius >= columns - 1 and col + radius >= columns - 1
+            if len(indices) >= count and (
+                    everything or np.sort(distances)[count - 1] <= searched):
+                break
+            radius += 1
+        order = np.lexsort((indices, distances))[:count]
+        return Sprite._from_records(self.__records[indices[order]])
+
+
+class ArrayImage():
+    """Image whose pixels are an ndarray or a raw buffer held in memory
+
+    It has the part of the PIL Image interface which SpriteSheet uses, and
+    np.asarray gives its pixels without copy, so a SpriteSheet detects
+    sprites in it without PIL.
+    """
+    __slots__ = ('__pixels', '__mode', '__palette')
+
+    def __init__(self, pixels, mode=None, shape=None, palette=None):
+        """
+        Arguments:
+            pixels {ndarray or buffer} -- uint8 pixels, or any object with
+                the buffer protocol (bytes, memoryview, mmap...) holding them
+                row by row
+
+        Keyword Arguments:
+            mode {str} -- 'L', 'P', 'LA', 'RGB' or 'RGBA', guessed from the
+                number of bands if not defined, or 'RGBA' for a flat buffer
+                (default: {None})
+            shape {tuple} -- (height, width) of a flat buffer, the shape of
+                an ndarray is its own (default: {None})
+            palette {list} -- Palette of a 'P' mode image (default: {None})
+
+        Raises:
+            ValueError: The pixels are not uint8
+            ValueError: Flat buffer without shape
+            ValueError: Unknown mode or mode not matching the bands
+        """
+        if not isinstance(pixels, np.ndarray):
+            pixels = np.asarray(memoryview(pixels))
+        if pixels.ndim == 1 and pixels.dtype != np.uint8:
+            pixels = pixels.view(np.uint8)
+        if pixels.dtype != np.uint8:
+            raise ValueError('Pixels must be uint8')
+        if pixels.ndim == 1:
+            if shape is None:
+                raise ValueError('The shape of a flat buffer must be given')
+            mode = mode or 'RGBA'
+            bands = next((count for count, modes in ARRAY_MODES.items()
+                          if mode in modes), None)
+            if bands is None:
+                raise ValueError('Unknown mode: {}'.format(mode))
+            pixels = pixels.reshape(tuple(shape) + ((bands,) if bands > 1
+                                                     else ()))
+        bands = pixels.shape[2] if pixels.ndim == 3 else 1
+        if pixels.ndim > 3 or bands not in ARRAY_MODES:
+            raise ValueError('Pixels must have 1 to 4 bands')
+        mode = mode or ARRAY_MODES[bands][0]
+        if mode not in ARRAY_MODES[bands]:
+            raise ValueError('Mode {} does not have {} bands'.format(mode,
+                                                                     bands))
+        self.__pixels = pixels
+        self.__mode = mode
+        self.__palette = palette
+
+    @property
+    def __array_interface__(self):
+        return self.__pixels.__array_interface__
+
+    @property
+    def mode(self):
+        return self.__mode
+
+    @property
+    def width(self):
+        return self.__pixels.shape[1]
+
+    @property
+    def height(self):
+        return self.__pixels.shape[0]
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def load(self):
+        """Do nothing, the pixels are already in memory"""
+
+    def getpalette(self):
+        return None if self.__palette is None else list(self.__palette)
+
+    def crop(self, box):
+        """Get a rectangle of the image, without copy
+
+        Arguments:
+            box {tuple} -- (left, top, right, bottom), right and bottom are
+                exclusive
+
+        Returns:
+            ArrayImage -- Image sharing the pixels of this one
+        """
+        left, top, right, bottom = box
+        return ArrayImage(self.__pixels[top:bottom, left:right], self.__mode,
+                          palette=self.__palette)
 
 
 class SpriteSheet():
@@ -65,196 +1453,867 @@ class SpriteSheet():
     Raises:
         FileNotFoundError: When file path is not found
     """
-    def __init__(self, fd, background_color=None):
-        print('Saving image...')
-        try:
-            self.image = Image.open(fd)
-        except FileNotFoundError:
-            raise FileNotFoundError("No such file or directory")
-        except Exception as e:
-            if "Image" in str(e):
-                self.image = fd
-            else:
-                raise Exception("This is not Image object or Image File Path")
-        print('Image mode: ', self.image.mode)
-        if not background_color and self.image.mode != 'RGBA':
-            background_color = self.find_most_common_color(self.image)
-        self.__background_color = background_color
+    def __init__(self, fd, background_color=None, cache=None, mode=None,
+                 shape=None):
+        """
+        Arguments:
+            fd {str or file or Image or ndarray or buffer} -- Path or file
+                object of an image file, PIL Image object, ArrayImage, or
+                pixels as an ndarray or a raw buffer (bytes, memoryview,
+                mmap...), which are used without copy and without PIL
+
+        Keyword Arguments:
+            background_color {tuple or int} -- Color of the image background,
+                the most common color if not defined (default: {None})
+            cache {DetectionCache} -- Persistent cache of detection results
+                (default: {None})
+            mode {str} -- Mode of ndarray or buffer pixels, see ArrayImage
+                (default: {None})
+            shape {tuple} -- (height, width) of a flat buffer
+                (default: {None})
+        """
+        logger.debug('Opening image...')
+        if isinstance(fd, BUFFER_TYPES):
+            fd = ArrayImage(fd, mode, shape)
+        if isinstance(fd, ArrayImage):
+            self.image = fd
+        else:
+            from PIL import Image
+            try:
+                self.image = Image.open(fd)
+            except FileNotFoundError:
+                raise FileNotFoundError("No such file or directory")
+            except Exception as e:
+                if "Image" in str(e):
+                    self.image = fd
+                else:
+                    raise Exception("This is not Image object or Image File "
+                                    "Path")
+        pixels = self.image.width * self.image.height
+        with stage('decode', pixels):
+            self.image.load()
+        logger.debug('Image mode: %s', self.image.mode)
+        if not background_color and self.image.mode not in ('LA', 'RGBA'):
+            with stage('background', pixels):
+                background_color = self.find_most_common_color(self.image)
+        self.background_color = background_color
+        self.__cache = cache
+        self.__pixels = None
+        # The pixels of an ArrayImage are the caller's buffer.
+        self.__owned = False
     
     @property
     def background_color(self):
         return self.__background_color
 
+    @property
+    def pixels(self):
+        """Get the pixels of the image as a read-only ndarray
+
+        The array is built once, sprite pixels are views on it and see the
+        edits applied by update_sprites.
+
+        Returns:
+            ndarray -- Pixels of the image
+        """
+        if self.__pixels is None:
+            self.__owned = not isinstance(self.image, ArrayImage)
+            self.__pixels = np.array(self.image) if self.__owned \
+                else np.asarray(self.image)
+        return _read_only(self.__pixels)
+
+    def __edit_pixels(self, x1, y1, x2, y2, edited):
+        """Write an edited rectangle into the pixels, copying them first if
+        they are the caller's buffer, which is never written
+
+        Arguments:
+            x1 {int} -- First row of the rectangle
+            y1 {int} -- First column of the rectangle
+            x2 {int} -- Last row of the rectangle
+            y2 {int} -- Last column of the rectangle
+            edited {ndarray} -- New pixels of the rectangle
+        """
+        if not self.__owned:
+            self.__pixels = np.array(self.__pixels)
+            self.__owned = True
+        self.__pixels[x1:x2 + 1, y1:y2 + 1] = edited
+
+    @background_color.setter
+    def background_color(self, background_color):
+        if self.image.mode == 'RGBA' and isinstance(background_color, tuple) \
+                and len(background_color) == 3:
+            background_color = background_color + (255,)
+        elif self.image.mode == 'LA' and isinstance(background_color, int):
+            background_color = (background_color, 255)
+        self.__background_color = background_color
+        self.__detection = None
+
     @staticmethod
-    def find_most_common_color(img):
+    def find_most_common_color(img, border=False, stride=1):
         """Find the most commonly used color in the image
-        
+
+        Pixels are packed into integer keys and counted with NumPy, and the
+        count can be estimated from a sample of the pixels only.
+
         Arguments:
             img {Image} -- PIL Image object
-        
+
+        Keyword Arguments:
+            border {bool} -- Only count the pixels of the image border,
+                where the background usually is (default: {False})
+            stride {int} -- Only count one pixel every stride pixels, in
+                both directions (default: {1})
+
         Returns:
             tuple or int -- The most commly used color of image, tuple or int based on type
         """
-        colors = img.getcolors(maxcolors=img.width*img.height)
-        return max(colors, key=lambda item: item[0])[1]
+        if img.mode == '1':
+            img = img.convert('L')
+        pixels = np.asarray(img)
+        # Bands of a pixel, empty for single band images; border pixels
+        # lose the image shape once concatenated.
+        bands = pixels.shape[2:]
+        if border:
+            pixels = np.concatenate([pixels[0], pixels[-1],
+                                     pixels[1:-1, 0], pixels[1:-1, -1]])
+            pixels = pixels[::stride]
+        else:
+            pixels = pixels[::stride, ::stride]
+        pixels = pixels.reshape((-1,) + bands)
+        if pixels.dtype != np.uint8:
+            colors, counts = np.unique(pixels, axis=0, return_counts=True)
+            color = colors[np.argmax(counts)]
+            return color.item() if color.ndim == 0 else tuple(color.tolist())
+        if pixels.ndim == 1:
+            return int(np.argmax(np.bincount(pixels, minlength=256)))
+        bands = pixels.shape[1]
+        keys = np.zeros(len(pixels), dtype=np.uint32)
+        for band in range(bands):
+            keys |= pixels[:, band].astype(np.uint32) << 8 * (bands - 1 - band)
+        colors, counts = np.unique(keys, return_counts=True)
+        key = int(colors[np.argmax(counts)])
+        return tuple((key >> 8 * (bands - 1 - band)) & 0xFF
+                     for band in range(bands))
+
+    def __background_test(self, tolerance=0):
+        """Choose the test of single pixels of the flood fill engine, once
+        for all pixels of the image
+
+        Keyword Arguments:
+            tolerance {int} -- Largest difference of a band from the
+                background color, or largest alpha, of a background pixel
+                (default: {0})
 
-    def __is_background(self, point):
-        """Check if an image pixel is background or not
-        
-        Arguments:
-            point {tuple} -- Color of the pixel
-            background_color {tuple} -- Color of the image backgrounf
-        
         Returns:
-            boolean -- Pixel is background or not
+            function -- Function of the color of a pixel, True when it is
+                background
         """
         background = self.background_color
         mode = self.image.mode
-        if not background and mode == 'RGBA':
-            if point[3] == 0:
-                return True
-            else: 
-                return False
-        if mode not in ['RGB', 'RGBA'] and point == background:
-            return True
-        elif mode not in ['RGB', 'RGBA']: 
-            return False
-        if list(point) == list(background):
-            return True
-        else:
-            return False
-        
+        if not background and mode in ('LA', 'RGBA'):
+            return lambda point: point[-1] <= tolerance
+        if mode == 'P' and tolerance:
+            palette = (self.image.getpalette() or []) + [0] * 768
+            colors = [palette[3 * index:3 * index + 3]
+                      for index in range(256)]
+            near = [all(abs(band - background_band) <= tolerance
+                        for band, background_band in
+                        zip(color, colors[background]))
+                    for color in colors]
+            return lambda point: near[point]
+        if mode not in ('LA', 'RGB', 'RGBA'):
+            background = int(background)
+            return lambda point: abs(int(point) - background) <= tolerance
+        return lambda point: all(
+            abs(int(band) - int(background_band)) <= tolerance
+            for band, background_band in zip(point, background))
 
+    def __mask_kernel(self, tolerance=0):
+        """Choose the foreground mask kernel of the image
+
+        Keyword Arguments:
+            tolerance {int} -- Largest difference of a band from the
+                background color, or largest alpha, of a background pixel
+                (default: {0})
 
-    def __create_sprite(self, label, label_map):
-        """Create a Sprite object with specified label and label_map
-        
-        Arguments:
-            label {int} -- Sprite label
-            label_map {2d list} -- Label map contains sprite label
-        
         Returns:
-            Sprite -- Sprite object with label argument
+            function -- Function of an ndarray of pixels giving the 2d
+                boolean array, True for sprite pixels
         """
-        sprite = {'label': label}
-        pos = np.array(label_map, dtype=np.int64)
-        pos = np.argwhere(pos==label)
-        sprite['x1'] = int(min([x[0] for x in pos]))
-        sprite['x2'] = int(max([x[0] for x in pos]))
-        sprite['y1'] = int(min([x[1] for x in pos]))
-        sprite['y2'] = int(max([x[1] for x in pos]))
-        return Sprite(sprite['label'], sprite['x1'], sprite['y1'], 
-                        sprite['x2'], sprite['y2'])
-
+        palette = None
+        if self.image.mode == 'P' and tolerance:
+            palette = self.image.getpalette()
+        return _mask_kernel(self.image.mode, self.background_color,
+                            tolerance, palette)
 
-    def __find_whole_sprite(self, label_map, lst_pixel, checked, r_idx, c_idx, label):
+    def __find_whole_sprite(self, label_map, lst_pixel, checked, r_idx, c_idx,
+                            label, is_background, connectivity=4):
         """Check out whole sprite from specified spite pixel
         
         Arguments:
-            label_map {2d list} -- List corresponding to sprite label in image
-            lst_pixel {2d list} -- List of all pixel in the image
-            checked {2d list} -- List of checked on in the label_map
+            label_map {ndarray} -- Array corresponding to sprite label in image
+            lst_pixel {ndarray} -- Array of all pixel in the image
+            checked {ndarray} -- Boolean array of checked on in the label_map
             r_idx {int} -- Row index of found pixel
             c_idx {int} -- Col index of found pixel
             label {int} -- Label of the new sprite
+            is_background {function} -- Background test of a pixel
+
+        Keyword Arguments:
+            connectivity {int} -- 4 or 8 neighbour connectivity (default: {4})
         """
-        background_color = self.background_color
         way = [(r_idx, c_idx)]
         while len(way) > 0:
             row, col = way.pop(0)
-            label_map[row][col] = label 
-            for x, y in [(row - 1, col), (row + 1, col),
-                        (row, col - 1), (row, col + 1)]:
+            label_map[row, col] = label
+            neighbours = [(row - 1, col), (row + 1, col),
+                          (row, col - 1), (row, col + 1)]
+            if connectivity == 8:
+                neighbours += [(row - 1, col - 1), (row - 1, col + 1),
+                               (row + 1, col - 1), (row + 1, col + 1)]
+            for x, y in neighbours:
                 if 0 <= x <= len(lst_pixel) - 1 and \
                     0 <= y <= len(lst_pixel[0]) - 1 and \
-                    not checked[x][y] and \
-                    not self.__is_background(lst_pixel[row][col]):
-                    checked[x][y] = True
+                    not checked[x, y] and \
+                    not is_background(lst_pixel[x, y]):
+                    checked[x, y] = True
                     way.append((x, y))
 
 
-    def find_sprites(self):
-        """Get an image as argument and then find all sprites in that image 
-        by checking each pixel's color
-        
+    def __label_numpy(self, lst_pixel, options):
+        """Label all sprites with the vectorized run-based union-find engine
+
         Arguments:
-            image {Image} -- Image to find sprites
-        
+            lst_pixel {ndarray} -- Pixels of the image
+            options {dict} -- Parameters of the detection
+
         Returns:
-            tuple -- Dictionary of sprite information and label_map of 
-                corresponding sprites found
+            tuple -- label_map ndarray of the sprites and number of sprites
         """
-        print('Finding sprites in this image...')
-        image = self.image
-        lst_pixel = np.asarray(image)
-        checked = [[False for col in row] for row in lst_pixel]
+        mask_kernel = self.__mask_kernel(options['tolerance'])
+        return _label_mask(mask_kernel(lst_pixel), options['connectivity'])
+
+
+    def __label_tiled(self, options, tile_size, label_file):
+        """Label all sprites tile by tile, reading one tile of pixels at a time
+
+        Arguments:
+            options {dict} -- Parameters of the detection
+            tile_size {int} -- Width and height of the tiles
+            label_file {str} -- Path of the file which stores the label_map
+
+        Returns:
+            tuple -- label_map memmap of the sprites and number of sprites
+        """
+        mask_kernel = self.__mask_kernel(options['tolerance'])
+
+        def mask_tile(top, left, bottom, right):
+            tile = self.image.crop((left, top, right, bottom))
+            return mask_kernel(np.asarray(tile))
+
+        shape = (self.image.height, self.image.width)
+        return _label_tiled(mask_tile, shape, tile_size, options['min_size'],
+                            label_file, options['connectivity'])
+
+
+    def __label_python(self, lst_pixel, options):
+        """Label all sprites with the pixel by pixel flood fill engine
+
+        Arguments:
+            lst_pixel {ndarray} -- Pixels of the image
+            options {dict} -- Parameters of the detection
+
+        Returns:
+            tuple -- label_map ndarray of the sprites and number of sprites
+        """
+        is_background = self.__background_test(options['tolerance'])
+        checked = np.zeros(lst_pixel.shape[:2], dtype=bool)
         label = 0 
-        sprites = {}
-        label_map = [[0 for col in row] for row in lst_pixel]
-        background_color = self.__background_color
+        label_map = np.zeros(lst_pixel.shape[:2], dtype=np.uint32)
         for row_idx, row in enumerate(lst_pixel):
             for col_idx, point in enumerate(row):   
-                if not self.__is_background(point) and \
-                    not checked[row_idx][col_idx]: 
+                if not is_background(point) and \
+                    not checked[row_idx, col_idx]:
                     label += 1
-                    checked[row_idx][col_idx] = True
+                    checked[row_idx, col_idx] = True
                     self.__find_whole_sprite(label_map, lst_pixel, checked, 
-                                                row_idx, col_idx, label)
-                    sprites[label] = self.__create_sprite(label, label_map)
-        return (sprites, label_map)
+                                                row_idx, col_idx, label,
+                                                is_background,
+                                                options['connectivity'])
+        return label_map.astype(_label_dtype(label), copy=False), label
 
 
-    def create_sprite_labels_image(self):
-        """Create an image containing mask for all sprite based on label_map
+    def find_sprites(self, engine='numpy', as_array=False, min_size=1,
+                     tile_size=None, label_file=None, workers=None,
+                     tolerance=0, connectivity=4):
+        """Get an image as argument and then find all sprites in that image 
+        by checking each pixel's color
         
+        Keyword Arguments:
+            engine {str} -- Labeling engine, 'numpy' for the vectorized
+                union-find or 'python' for the pixel by pixel flood fill
+                (default: {'numpy'})
+            as_array {bool} -- Return the label_map as a read-only uint16
+                or uint32 ndarray, sized to the number of sprites, instead of
+                a 2d list (default: {False})
+            min_size {int} -- Minimum number of pixels of a sprite, smaller
+                ones are erased from the label_map and the remaining sprites
+                are numbered again from 1 (default: {1})
+            tile_size {int} -- Label the image by tiles of this size, with
+                the 'numpy' engine, so the working memory is bounded by the
+                tile size; the label_map is then always returned as a
+                read-only memmap, whatever as_array (default: {None})
+            label_file {str} -- Path of the file which stores the label_map
+                memmap of tiled detection, a temporary file is used if not
+                defined (default: {None})
+            workers {int} -- Label the image by horizontal bands in this
+                many processes, with the 'numpy' engine; the result is
+                identical to serial detection (default: {None})
+            tolerance {int} -- A pixel is background when none of its bands
+                differs from the background color by more than tolerance or,
+                for an LA or RGBA image without background color, when its
+                alpha is at most tolerance (default: {0})
+            connectivity {int} -- 4 to join only the pixels sharing a side
+                into a sprite, 8 to also join the pixels sharing a corner
+                (default: {4})
+
+        Raises:
+            ValueError: Unknown engine
+            ValueError: connectivity is neither 4 nor 8
+            ValueError: Tiled or parallel detection with the 'python' engine
+            ValueError: Both tiled and parallel detection
+
+        Returns:
+            tuple -- Dictionary of sprite information and label_map of 
+                corresponding sprites found, the same result is returned
+                again until the background color or the arguments change
+        """
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        if connectivity not in (4, 8):
+            raise ValueError('Connectivity must be 4 or 8')
+        if (tile_size or workers) and engine != 'numpy':
+            raise ValueError('Tiled and parallel detection need the numpy '
+                             'engine')
+        if tile_size and workers:
+            raise ValueError('Tiled detection cannot run in parallel')
+        options = self.__options(min_size, tolerance, connectivity)
+        key = self.__key(options, engine, tile_size, label_file, workers)
+        detection = self.__detection
+        if detection is None or detection[0] != key:
+            label_map, regions = self.__detect(options, engine, tile_size,
+                                               label_file, workers)
+            with stage('sprites', label_map.size):
+                sprites = _create_sprites(regions)
+            detection = key, sprites, label_map, regions
+            self.__detection = detection
+        _, sprites, label_map, _ = detection
+        # A list of the tiled label map would hold every label in memory.
+        return (sprites, _read_only(label_map) if as_array or tile_size
+                else label_map.tolist())
+
+
+    def group_sprites(self, gap=0, as_array=False, **options):
+        """Merge the sprites whose bounding boxes are close into one sprite
+
+        Detached parts, such as a floating hat or the particles of an
+        effect, become one sprite. Groups are transitive: sprites close to
+        the same sprite are merged together.
+
+        Keyword Arguments:
+            gap {int} -- Largest number of background rows and columns
+                between the bounding boxes of two merged sprites, 0 merges
+                the overlapping and adjacent boxes (default: {0})
+            as_array {bool} -- Return the label_map as an ndarray instead
+                of a 2d list (default: {False})
+            options -- Keyword arguments of find_sprites, its last result is
+                reused when they do not change it
+
+        Raises:
+            ValueError: gap is negative
+
+        Returns:
+            tuple -- Sprites of the groups and label_map of the groups,
+                numbered in the raster order of their first pixel
+        """
+        if gap < 0:
+            raise ValueError('The gap cannot be negative')
+        options['as_array'] = True
+        _, label_map = self.find_sprites(**options)
+        regions = self.__detection[3]
+        with stage('grouping', label_map.size):
+            label_map, regions = _group_regions(label_map, regions, gap)
+        with stage('sprites', label_map.size):
+            sprites = _create_sprites(regions)
+        if not as_array:
+            label_map = label_map.tolist()
+        return (sprites, label_map)
+
+    def find_sprite_boxes(self, min_size=1, tolerance=0, connectivity=4):
+        """Find the bounding boxes and pixel counts of the sprites, without
+        building a label map
+
+        The image is scanned by bands of rows, keeping only the labels of
+        the last row of a band and the properties of the sprites, so the
+        working memory is about the width of the image plus the number of
+        sprites. The sprites are the same as the ones of find_sprites.
+
+        Keyword Arguments:
+            min_size {int} -- Minimum number of pixels of a sprite
+                (default: {1})
+            tolerance {int} -- Tolerance of the background color
+                (default: {0})
+            connectivity {int} -- 4 or 8 neighbour connectivity
+                (default: {4})
+
+        Raises:
+            ValueError: connectivity is neither 4 nor 8
+
+        Returns:
+            SpriteCollection -- Sprites by label
+        """
+        if connectivity not in (4, 8):
+            raise ValueError('Connectivity must be 4 or 8')
+        mask_kernel = self.__mask_kernel(tolerance)
+        height, width = self.image.height, self.image.width
+
+        def mask_rows(top, bottom):
+            return mask_kernel(np.asarray(
+                self.image.crop((0, top, width, bottom))))
+
+        with stage('labeling', height * width):
+            regions = _stream_regions(mask_rows, (height, width), min_size,
+                                      connectivity)
+        with stage('sprites', height * width):
+            return _create_sprites(regions)
+
+
+    def __options(self, min_size, tolerance, connectivity):
+        """Get the parameters which change the detection result
+
         Arguments:
-            sprites {dictionary} -- Container of all Sprite object
-            label_map {2d list} -- Label_map of image
-        
+            min_size {int} -- Minimum number of pixels of a sprite
+            tolerance {int} -- Tolerance of the background color
+            connectivity {int} -- 4 or 8 neighbour connectivity
+
+        Returns:
+            dict -- Parameters of the detection
+        """
+        return {'background_color': self.background_color,
+                'min_size': min_size, 'tolerance': tolerance,
+                'connectivity': connectivity}
+
+    @staticmethod
+    def __key(options, engine='numpy', tile_size=None, label_file=None,
+              workers=None):
+        """Get the key of a detection result, which is reused only by the
+        calls of find_sprites with the same key
+
+        Arguments:
+            options {dict} -- Parameters of the detection
+
         Keyword Arguments:
-            background_color {tuple} -- Background color of new image (default: {None}) 
-        
+            engine {str} -- Labeling engine (default: {'numpy'})
+            tile_size {int} -- Size of the tiles (default: {None})
+            label_file {str} -- Path of the label_map memmap
+                (default: {None})
+            workers {int} -- Number of processes (default: {None})
+
+        Returns:
+            tuple -- Parameters of the detection, then the way it was run
+        """
+        return (options, engine, tile_size, label_file, workers)
+
+
+    def update_sprites(self, image=None, dirty=None, as_array=False,
+                       min_size=1, tolerance=0, connectivity=4):
+        """Find the sprites again after an edit of the image, labeling only
+        the sprites around the edited pixels
+
+        The edit is given either as the edited image, compared with the
+        current one to find the changed pixels, or as the rectangle of
+        self.image which was drawn on. The result is the same as
+        find_sprites on the edited image; without a previous detection with
+        the same parameters, the whole image is labeled.
+
+        Keyword Arguments:
+            image {Image or ndarray or buffer} -- Edited image, of the same
+                size and mode, which replaces self.image (default: {None})
+            dirty {tuple} -- Edited rectangle (x1, y1, x2, y2), inclusive,
+                in the coordinates of Sprite.top_left (default: {None})
+            as_array {bool} -- Return the label_map as a read-only ndarray
+                instead of a 2d list (default: {False})
+            min_size {int} -- Minimum number of pixels of a sprite
+                (default: {1})
+            tolerance {int} -- Tolerance of the background color
+                (default: {0})
+            connectivity {int} -- 4 or 8 neighbour connectivity
+                (default: {4})
+
+        Raises:
+            ValueError: Neither or both of image and dirty are given
+            ValueError: The edited image differs in size or mode
+
+        Returns:
+            tuple -- Sprites and label_map, as returned by find_sprites
+        """
+        if (image is None) == (dirty is None):
+            raise ValueError('Give either the edited image or the dirty '
+                             'rectangle')
+        if connectivity not in (4, 8):
+            raise ValueError('Connectivity must be 4 or 8')
+        pixels = self.pixels
+        height, width = pixels.shape[:2]
+        if image is not None:
+            if isinstance(image, BUFFER_TYPES):
+                image = ArrayImage(image, self.image.mode,
+                                   (height, width), self.image.getpalette())
+            if image.size != self.image.size or image.mode != self.image.mode:
+                raise ValueError('The edited image must have the same size '
+                                 'and mode')
+            edited = np.asarray(image)
+            changed = edited != pixels
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            rows = np.nonzero(changed.any(axis=1))[0]
+            cols = np.nonzero(changed.any(axis=0))[0]
+            self.image = image
+            if isinstance(image, ArrayImage):
+                self.__pixels, self.__owned = edited, False
+            if not len(rows):
+                return self.find_sprites(as_array=as_array, min_size=min_size,
+                                         tolerance=tolerance,
+                                         connectivity=connectivity)
+            dirty = (int(rows[0]), int(cols[0]), int(rows[-1]), int(cols[-1]))
+            x1, y1, x2, y2 = dirty
+            if not isinstance(image, ArrayImage):
+                self.__edit_pixels(x1, y1, x2, y2,
+                                   edited[x1:x2 + 1, y1:y2 + 1])
+        else:
+            x1, y1, x2, y2 = dirty
+            x1, y1 = max(x1, 0), max(y1, 0)
+            x2, y2 = min(x2, height - 1), min(y2, width - 1)
+            if x1 > x2 or y1 > y2:
+                raise ValueError('The dirty rectangle is outside the image')
+            dirty = (x1, y1, x2, y2)
+            if not isinstance(self.image, ArrayImage):
+                region = self.image.crop((y1, x1, y2 + 1, x2 + 1))
+                self.__edit_pixels(x1, y1, x2, y2, np.asarray(region))
+        options = self.__options(min_size, tolerance, connectivity)
+        detection = self.__detection
+        if detection is None or detection[0][0] != options:
+            self.__detection = None
+            return self.find_sprites(as_array=as_array, min_size=min_size,
+                                     tolerance=tolerance,
+                                     connectivity=connectivity)
+        _, _, label_map, regions = detection
+        mask_kernel = self.__mask_kernel(tolerance)
+
+        def mask_window(top, left, bottom, right):
+            return mask_kernel(self.__pixels[top:bottom, left:right])
+
+        with stage('labeling', (x2 - x1 + 1) * (y2 - y1 + 1)):
+            label_map, regions = _update_labels(
+                label_map, regions, dirty, mask_window, min_size,
+                connectivity)
+        with stage('sprites', label_map.size):
+            sprites = _create_sprites(regions)
+        self.__detection = self.__key(options), sprites, label_map, regions
+        return (sprites, _read_only(label_map) if as_array
+                else label_map.tolist())
+
+
+    def __detect(self, options, engine, tile_size, label_file, workers):
+        """Get the label map and region properties of the image, from the
+        persistent cache if there is one
+
+        Arguments:
+            options {dict} -- Parameters which change the detection result
+            engine {str} -- Labeling engine
+            tile_size {int} -- Size of the tiles of tiled detection
+            label_file {str} -- Path of the label_map of tiled detection
+            workers {int} -- Number of processes of parallel detection
+
+        Returns:
+            tuple -- label_map ndarray and dictionary of region properties
+        """
+        # The label map of tiled detection stays on disk, a cached one would
+        # be read whole into memory.
+        cache = None if tile_size or label_file else self.__cache
+        if cache:
+            key = cache.key(self.image, options)
+            detection = cache.load(key)
+            if detection is not None:
+                return detection
+        logger.debug('Finding sprites in this image...')
+        image = self.image
+        pixels = image.width * image.height
+        with stage('labeling', pixels):
+            label_map, count = self.__label(options, engine, tile_size,
+                                            label_file, workers)
+        with stage('regions', pixels):
+            regions = _region_properties(label_map, count)
+            if options['min_size'] > 1 and not tile_size:
+                label_map, regions = _filter_regions(label_map, regions,
+                                                     options['min_size'])
+        if cache:
+            cache.save(key, label_map, regions)
+        return label_map, regions
+
+
+    def __label(self, options, engine, tile_size, label_file, workers):
+        """Label the sprites of the image with the chosen engine and mode
+
+        Arguments:
+            options {dict} -- Parameters which change the detection result
+            engine {str} -- Labeling engine
+            tile_size {int} -- Size of the tiles of tiled detection
+            label_file {str} -- Path of the label_map of tiled detection
+            workers {int} -- Number of processes of parallel detection
+
+        Returns:
+            tuple -- label_map ndarray of the sprites and number of sprites
+        """
+        image = self.image
+        if tile_size:
+            label_map, count = self.__label_tiled(options, tile_size,
+                                                  label_file)
+        elif workers and workers > 1:
+            label_map, count = _label_parallel(
+                self.pixels, self.__mask_kernel(options['tolerance']),
+                workers, options['connectivity'])
+        elif engine == 'numpy':
+            label_map, count = self.__label_numpy(self.pixels, options)
+        else:
+            label_map, count = self.__label_python(self.pixels, options)
+        return label_map, count
+
+
+    def export_sprites(self, file, **options):
+        """Write the sprites and label map in the sprite file format
+
+        Rows of the label map are run-length encoded, next to the sprite
+        table and the detection parameters; spriteutil_final.spritefile.
+        SpriteFile reads them lazily.
+
+        Arguments:
+            file {str or file} -- Path or binary file object
+
+        Keyword Arguments:
+            options -- Keyword arguments of find_sprites, its last result is
+                reused when they do not change it
+        """
+        from spriteutil_final.spritefile import write_sprite_file
+        options['as_array'] = True
+        sprites, label_map = self.find_sprites(**options)
+        write_sprite_file(file, sprites, label_map, self.__detection[0][0])
+
+    def import_sprites(self, source):
+        """Read sprites exported for this image instead of finding them
+
+        find_sprites then returns them, without detection, when called with
+        the parameters stored in the file.
+
+        Arguments:
+            source {str or buffer or SpriteFile} -- Sprite file
+
+        Raises:
+            ValueError: The file is of an image of another size
+
+        Returns:
+            tuple -- Sprites and label_map ndarray
+        """
+        from spriteutil_final.spritefile import SpriteFile
+        if not isinstance(source, SpriteFile):
+            source = SpriteFile(source)
+        if source.shape != (self.image.height, self.image.width):
+            raise ValueError('The sprite file is of an image of another size')
+        options = self.__options(1, 0, 4)
+        options.update(source.options)
+        self.background_color = options['background_color']
+        sprites, label_map = source.sprites, source.label_map
+        records = sprites.records
+        regions = {name: np.concatenate([np.zeros(1, records.dtype[name]),
+                                         records[name]])
+                   for name in SPRITE_DTYPE.names[1:]}
+        self.__detection = self.__key(options), sprites, label_map, regions
+        return sprites, _read_only(label_map)
+
+    def crop_sprite(self, sprite):
+        """Get the pixels of the bounding box of a sprite, without copy
+
+        Arguments:
+            sprite {Sprite} -- Sprite of this image
+
+        Returns:
+            ndarray -- Read-only view on the pixels of the image
+        """
+        return self.pixels[sprite.slices]
+
+    def sprite_mask(self, sprite, **options):
+        """Get the mask of the pixels of a sprite within its bounding box
+
+        Only the bounding box of the label map is read, so this also works
+        on the memmap label map of tiled detection.
+
+        Arguments:
+            sprite {Sprite} -- Sprite found by find_sprites
+            options -- Keyword arguments of find_sprites
+
+        Returns:
+            ndarray -- 2d boolean array, True for the pixels of the sprite
+        """
+        options['as_array'] = True
+        _, label_map = self.find_sprites(**options)
+        return label_map[sprite.slices] == sprite.label
+
+    def iter_sprites(self, **options):
+        """Iterate over the sprites with their pixels and masks
+
+        Pixels are views on the image and masks are built one at a time,
+        so no more than one sprite is materialised at once.
+
+        Arguments:
+            options -- Keyword arguments of find_sprites
+
+        Returns:
+            generator -- Tuples of Sprite, read-only ndarray view of its
+                bounding box pixels and 2d boolean mask of its pixels
+        """
+        options['as_array'] = True
+        sprites, label_map = self.find_sprites(**options)
+        pixels = self.pixels
+        for sprite in sprites.values():
+            slices = sprite.slices
+            yield sprite, pixels[slices], label_map[slices] == sprite.label
+
+    def iter_frames(self, track=False, as_array=False, min_size=1,
+                    tolerance=0, connectivity=4):
+        """Find the sprites of every frame of an animated image
+
+        Frames are read one at a time. Only the sprites around the pixels
+        which changed since the previous frame are labeled again, as with
+        update_sprites, so the time is about the one of the changed pixels.
+        A frame whose mode or palette changes is labeled whole.
+
+        Keyword Arguments:
+            track {bool} -- Follow the sprites from frame to frame: a
+                sprite keeps the identity of the previous sprite with the
+                same first pixel, else of the one it overlaps most
+                (default: {False})
+            as_array {bool} -- Yield the label_map as an ndarray instead of
+                a 2d list (default: {False})
+            min_size {int} -- Minimum number of pixels of a sprite
+                (default: {1})
+            tolerance {int} -- Tolerance of the background color
+                (default: {0})
+            connectivity {int} -- 4 or 8 neighbour connectivity
+                (default: {4})
+
+        Returns:
+            generator -- Tuples of frame index, sprites, label_map and, when
+                tracking, ndarray of the identity of each label, the same
+                sprite keeping the same identity in all frames (else None)
+        """
+        from PIL import ImageSequence
+        options = {'min_size': min_size, 'tolerance': tolerance,
+                   'connectivity': connectivity}
+        frames = [self.image] if isinstance(self.image, ArrayImage) else \
+            ImageSequence.Iterator(self.image)
+        sheet = previous = None
+        next_id = 1
+        try:
+            for index, frame in enumerate(frames):
+                if not isinstance(frame, ArrayImage):
+                    frame = frame.copy()
+                if sheet is not None and frame.mode == sheet.image.mode and \
+                        frame.getpalette() == sheet.image.getpalette():
+                    sprites, label_map = sheet.update_sprites(
+                        image=frame, as_array=True, **options)
+                else:
+                    background = self.background_color if sheet is None \
+                        else _convert_color(sheet.image,
+                                            sheet.background_color,
+                                            frame.mode)
+                    sheet = SpriteSheet(frame, background, self.__cache)
+                    sprites, label_map = sheet.find_sprites(as_array=True,
+                                                            **options)
+                regions = sheet.__detection[3]
+                if 'first' not in regions:
+                    regions = _region_properties(label_map, len(sprites))
+                ids = None
+                if track:
+                    if previous is None:
+                        ids = np.arange(len(sprites) + 1)
+                        next_id = len(sprites) + 1
+                    else:
+                        ids, next_id = _track_sprites(*previous, label_map,
+                                                      regions, next_id)
+                    previous = label_map, regions, ids
+                yield (index, sprites,
+                       label_map if as_array else label_map.tolist(), ids)
+        finally:
+            if not isinstance(self.image, ArrayImage):
+                self.image.seek(0)
+
+    def create_sprite_labels_image(self, seed=None, palette=False, **options):
+        """Create an image containing mask for all sprite based on label_map
+
+        Every sprite gets a unique random color, looked up from a color
+        table indexed by the label map in one gather, and a bounding box.
+
+        Keyword Arguments:
+            seed {int} -- Seed of the random sprite colors, the same seed
+                always gives the same colors (default: {None})
+            palette {bool} -- Create a 'P' mode image with the color table
+                as its palette, this needs fewer than 256 sprites
+                (default: {False})
+            options -- Keyword arguments of find_sprites, its last result is
+                reused when they do not change it
+
+        Raises:
+            ValueError: Too many sprites for a palette image
+
         Returns:
             Image -- Image of all sprite mask
         """
+        from PIL import Image
         background_color = self.background_color
         if not background_color and not isinstance(background_color, int):
             mode = 'RGBA'
+        elif isinstance(background_color, tuple) and len(background_color) == 2:
+            # Gray and alpha of an LA image.
+            background_color = background_color[:1] * 3 + background_color[1:]
+            mode = 'RGBA'
         elif isinstance(background_color, tuple) and len(background_color) == 4:
             mode = 'RGBA'
         else: 
             mode = 'RGB'
-        sprites, label_map = self.find_sprites()
-        print('Creating label mask for all image sprites...')
-        image_size = (len(label_map[0]), len(label_map))
-        mask = Image.new(mode, image_size, background_color)
-        sprite_colors = {'0': background_color}
-        for label in sprites.keys():
-            while True:
-                red = random.randint(0, 255)
-                green = random.randint(0, 255)
-                blue = random.randint(0, 255)
-                if not (red, green, blue) in [sprite_colors[key] 
-                        for key in sprite_colors.keys()]:
-                    if mode == 'RGBA':
-                        sprite_colors[label] = (red, green, blue, 255)
-                    else:
-                        sprite_colors[label] =  (red, green, blue)
-                    break 
-        width, height = mask.size
-        for x in range(width):
-            for y in range(height):
-                if label_map[y][x] != 0:
-                    mask.putpixel((x, y), sprite_colors[label_map[y][x]])
-        for label in sprites.keys():
-            sprite = sprites[label]
-            for x in range(sprite.top_left[0], sprite.bottom_right[0] + 1):
-                mask.putpixel((sprite.bottom_right[1], x), sprite_colors[label])
-                mask.putpixel((sprite.top_left[1], x), sprite_colors[label])
-            for x in range(sprite.top_left[1], sprite.bottom_right[1] + 1):
-                mask.putpixel((x, sprite.top_left[0]), sprite_colors[label])
-                mask.putpixel((x, sprite.bottom_right[0]), sprite_colors[label])
-        print('Successfully created sprites label mask!')
+        options['as_array'] = True
+        sprites, label_map = self.find_sprites(**options)
+        if palette and len(sprites) > 255:
+            raise ValueError('Too many sprites for a palette image')
+        logger.debug('Creating label mask for all image sprites...')
+        with stage('rendering', label_map.size):
+            colors = _sprite_colors(len(sprites), mode, Image.new(
+                mode, (1, 1), background_color).getpixel((0, 0)), seed)
+            indices = np.array(label_map, dtype=np.uint8 if palette
+                               else label_map.dtype)
+            records = sprites.records
+            rows, cols, boxes = _box_outlines(
+                records['top'], records['left'], records['bottom'],
+                records['right'])
+            # Boxes are drawn in label order, the last one drawn on a pixel
+            # keeps it.
+            pixels = rows * indices.shape[1] + cols
+            order = np.lexsort((boxes, pixels))
+            pixels, boxes = pixels[order], boxes[order]
+            last = np.ones(len(pixels), dtype=bool)
+            last[:-1] = pixels[1:] != pixels[:-1]
+            indices.reshape(-1)[pixels[last]] = records['label'][boxes[last]]
+            if palette:
+                mask = Image.fromarray(indices, 'P')
+                mask.putpalette(colors.tobytes(), mode)
+            else:
+                mask = Image.fromarray(colors[indices], mode)
         return mask
-
-
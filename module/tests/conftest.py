@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+
+
+def _sheet_pixels(mode, rng, shape, density):
+    """Draw noisy sprites on a background, with pixels close to the
+    background color so that tolerance changes the sprites"""
+    mask = rng.random(shape) < density
+    faint = rng.random(shape) < 0.5
+    if mode in ('L', 'P'):
+        sprite = rng.integers(1, 8 if mode == 'P' else 256, shape)
+        near = rng.integers(0, 3, shape)
+        return np.where(mask, sprite, np.where(faint, near, 0)).astype(
+            np.uint8)
+    bands = len(mode)
+    sprite = rng.integers(0, 256, shape + (bands,))
+    near = rng.integers(0, 3, shape + (bands,))
+    pixels = np.where(mask[..., None], sprite,
+                      np.where(faint[..., None], near, 0))
+    if mode == 'RGBA':
+        # Transparent background, sprites are opaque.
+        pixels[..., 3] = np.where(mask, 255, pixels[..., 3])
+    return pixels.astype(np.uint8)
+
+
+@pytest.fixture
+def make_sheet():
+    """Factory of reproducible sprite sheets, as (image, background_color)"""
+    def make(mode='L', seed=0, shape=(40, 50), density=0.35):
+        rng = np.random.default_rng(seed)
+        image = Image.fromarray(_sheet_pixels(mode, rng, shape, density),
+                                mode)
+        if mode == 'P':
+            palette = [0, 0, 0, 1, 1, 1] + \
+                rng.integers(0, 256, 6 * 3).tolist()
+            image.putpalette(palette + [0] * (768 - len(palette)))
+        background = {'L': 0, 'P': 0, 'RGB': (0, 0, 0), 'RGBA': None}[mode]
+        return image, background
+    return make
@@ -0,0 +1,30 @@
+"""Background color estimates of find_most_common_color"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+MODES = ('L', 'P', 'RGB', 'RGBA')
+
+SAMPLINGS = [{'border': True}, {'stride': 2}, {'border': True, 'stride': 3}]
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('sampling', SAMPLINGS)
+def test_sampled_color_type(make_sheet, mode, sampling):
+    image, _ = make_sheet(mode)
+    exact = SpriteSheet.find_most_common_color(image)
+    color = SpriteSheet.find_most_common_color(image, **sampling)
+    assert type(color) is type(exact)
+    assert np.shape(color) == np.shape(exact)
+
+
+@pytest.mark.parametrize('mode, color', [
+    ('L', 10), ('P', 10), ('RGB', (10, 20, 30)), ('RGBA', (10, 20, 30, 255))])
+@pytest.mark.parametrize('sampling', [{}] + SAMPLINGS)
+def test_uniform_sheet(mode, color, sampling):
+    image = Image.new(mode, (16, 16), color)
+    assert SpriteSheet.find_most_common_color(image, **sampling) == color
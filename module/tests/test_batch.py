@@ -0,0 +1,70 @@
+"""Batch detection of many sprite sheets"""
+
+import json
+import multiprocessing
+import os
+
+import pytest
+from PIL import Image
+
+from spriteutil_final import batch
+from spriteutil_final.batch import detect_many
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+@pytest.fixture
+def sheets(make_sheet, tmp_path):
+    paths = []
+    for index, directory in enumerate(['a', 'a', 'b', 'b']):
+        image, _ = make_sheet('RGB', seed=index, shape=(20, 30))
+        os.makedirs(tmp_path / directory, exist_ok=True)
+        path = str(tmp_path / directory / 'sheet{}.png'.format(index % 2))
+        image.save(path)
+        paths.append(path)
+    return paths
+
+
+def test_detect_many(sheets, tmp_path):
+    output = tmp_path / 'out'
+    results = {path: (sprites, error) for path, sprites, error in
+               detect_many(sheets, workers=2, output_dir=str(output))}
+    assert set(results) == set(sheets)
+    for path in sheets:
+        sprites, error = results[path]
+        assert error is None
+        assert len(sprites) == len(SpriteSheet(path).find_sprites()[0])
+        name = os.path.splitext(os.path.relpath(path, str(tmp_path)))[0]
+        with open(str(output / name) + '.json') as fd:
+            assert len(json.load(fd)) == len(sprites)
+        assert os.path.exists(str(output / name) + '_mask.png')
+
+
+def test_failing_sheet(sheets, tmp_path):
+    missing = str(tmp_path / 'missing.png')
+    results = {path: error for path, _, error in
+               detect_many(sheets + [missing], workers=2)}
+    assert results.pop(missing).startswith('FileNotFoundError')
+    assert not any(results.values())
+
+
+def _die_on_sheet1(path, *arguments):
+    if path.endswith('sheet1.png'):
+        os._exit(1)
+    return _detect_file(path, *arguments)
+
+
+_detect_file = batch._detect_file
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='workers must inherit the patched module')
+def test_worker_killed(sheets, monkeypatch):
+    monkeypatch.setattr(batch, '_detect_file', _die_on_sheet1)
+    results = [(path, error) for path, _, error in
+               detect_many(sheets * 3, workers=2)]
+    assert sorted(path for path, _ in results) == sorted(sheets * 3)
+    for path, error in results:
+        if path.endswith('sheet1.png'):
+            assert error.startswith('BrokenProcessPool')
+        else:
+            assert error is None
@@ -0,0 +1,68 @@
+"""Persistent cache of detection results"""
+
+import os
+
+import numpy as np
+
+from spriteutil_final.cache import DetectionCache
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+def test_cached_result(make_sheet, tmp_path):
+    image, background = make_sheet('RGB')
+    cache = DetectionCache(str(tmp_path))
+    expected = SpriteSheet(image, background, cache).find_sprites(
+        as_array=True, min_size=2)
+    assert len(os.listdir(str(tmp_path))) == 1
+    sprites, label_map = SpriteSheet(image, background, cache).find_sprites(
+        as_array=True, min_size=2)
+    np.testing.assert_array_equal(label_map, expected[1])
+    np.testing.assert_array_equal(sprites.records, expected[0].records)
+
+
+def test_palette_in_key(make_sheet, tmp_path):
+    image, _ = make_sheet('P')
+    other = image.copy()
+    other.putpalette([0, 0, 0] + [255] * 765)
+    options = {'tolerance': 2}
+    assert DetectionCache.key(image, options) != \
+        DetectionCache.key(other, options)
+
+
+def test_tiled_detection_is_not_cached(make_sheet, tmp_path):
+    image, background = make_sheet('L')
+    cache = DetectionCache(str(tmp_path / 'cache'))
+    SpriteSheet(image, background, cache).find_sprites()
+    _, label_map = SpriteSheet(image, background, cache).find_sprites(
+        tile_size=16)
+    assert isinstance(label_map, np.memmap)
+    assert len(os.listdir(cache.directory)) == 1
+
+
+def test_eviction(make_sheet, tmp_path):
+    cache = DetectionCache(str(tmp_path), max_bytes=1)
+    # A result another process is writing.
+    writing = tmp_path / 'writing.tmp'
+    writing.write_bytes(b'\0' * 100)
+    for seed in range(3):
+        image, background = make_sheet('L', seed=seed)
+        SpriteSheet(image, background, cache).find_sprites()
+        names = set(os.listdir(str(tmp_path))) - {writing.name}
+        assert len(names) <= 1 and all(name.endswith('.npz')
+                                       for name in names)
+    cache.clear()
+    assert os.listdir(str(tmp_path)) == [writing.name]
+
+
+def test_evicted_while_loading(make_sheet, tmp_path, monkeypatch):
+    image, background = make_sheet('L')
+    cache = DetectionCache(str(tmp_path))
+    key = DetectionCache.key(image, {'min_size': 1})
+    cache.save(key, np.zeros((2, 2), np.uint16), {'area': np.zeros(1)})
+
+    def evicted(path, *arguments):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, 'utime', evicted)
+    label_map, regions = cache.load(key)
+    assert label_map.shape == (2, 2) and list(regions) == ['area']
@@ -0,0 +1,83 @@
+"""Grid queries of SpriteCollection against brute force"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+def boxes(sprites):
+    records = sprites.records
+    return records['top'], records['left'], records['bottom'], \
+        records['right']
+
+
+def expected_in_rect(sprites, x1, y1, x2, y2):
+    top, left, bottom, right = boxes(sprites)
+    inside = (top <= x2) & (bottom >= x1) & (left <= y2) & (right >= y1)
+    return sprites.records['label'][inside].tolist()
+
+
+def expected_nearest(sprites, x, y, count):
+    top, left, bottom, right = boxes(sprites)
+    distances = np.hypot(np.maximum(np.maximum(top - x, x - bottom), 0),
+                         np.maximum(np.maximum(left - y, y - right), 0))
+    labels = sprites.records['label']
+    order = np.lexsort((labels, distances))[:count]
+    return labels[order].tolist()
+
+
+def labels(found):
+    return [sprite.label for sprite in found]
+
+
+@pytest.fixture
+def corner_sprites():
+    """A 100x100 sheet whose only sprite is in a corner, so the grid covers
+    a small part of the sheet"""
+    image = Image.new('L', (100, 100), 0)
+    image.paste(255, (0, 0, 6, 6))
+    return SpriteSheet(image, 0).find_sprites()[0]
+
+
+@pytest.mark.parametrize('x, y, expected', [
+    (3, 3, [1]), (8, 50, []), (50, 8, []), (99, 99, []), (-1, -1, []),
+    (500, 500, []), (-500, 3, [])])
+def test_at_past_the_sprites(corner_sprites, x, y, expected):
+    assert labels(corner_sprites.at(x, y)) == expected
+
+
+@pytest.mark.parametrize('rect, expected', [
+    ((0, 0, 99, 99), [1]), ((6, 0, 99, 99), []), ((-50, -50, -1, 200), []),
+    ((-50, -50, 0, 0), [1]), ((5, 5, 5000, 5000), [1])])
+def test_in_rect_past_the_sprites(corner_sprites, rect, expected):
+    assert labels(corner_sprites.in_rect(*rect)) == expected
+
+
+def test_queries(make_sheet):
+    image, background = make_sheet('L', seed=20, shape=(60, 80),
+                                   density=0.08)
+    sprites = SpriteSheet(image, background).find_sprites(
+        connectivity=8)[0]
+    rng = np.random.default_rng(20)
+    for x, y in rng.integers(-30, 120, (200, 2)).tolist():
+        assert labels(sprites.at(x, y)) == \
+            expected_in_rect(sprites, x, y, x, y)
+        x2, y2 = x + int(rng.integers(0, 40)), y + int(rng.integers(0, 40))
+        assert labels(sprites.in_rect(x, y, x2, y2)) == \
+            expected_in_rect(sprites, x, y, x2, y2)
+        for count in (1, 3):
+            assert labels(sprites.nearest(x, y, count)) == \
+                expected_nearest(sprites, x, y, count)
+
+
+@pytest.mark.parametrize('x, y', [(10 ** 6, 0), (0, -10 ** 6),
+                                  (-10 ** 6, 10 ** 6)])
+def test_nearest_far_away(x, y):
+    image = Image.new('L', (40, 10), 0)
+    image.paste(255, (3, 3, 6, 6))
+    image.paste(255, (30, 2, 34, 9))
+    sprites = SpriteSheet(image, 0).find_sprites()[0]
+    assert labels(sprites.nearest(x, y, 2)) == \
+        expected_nearest(sprites, x, y, 2)
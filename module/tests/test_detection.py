@@ -0,0 +1,114 @@
+"""The labeling engines and detection modes against the pixel by pixel
+flood fill of engine='python'"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+MODES = ('L', 'P', 'RGB', 'RGBA')
+
+CASES = [{'tolerance': 0, 'connectivity': 4, 'min_size': 1},
+         {'tolerance': 0, 'connectivity': 8, 'min_size': 1},
+         {'tolerance': 2, 'connectivity': 4, 'min_size': 3},
+         {'tolerance': 2, 'connectivity': 8, 'min_size': 3}]
+
+
+def reference(image, background, **options):
+    return SpriteSheet(image, background).find_sprites(
+        engine='python', as_array=True, **options)
+
+
+def assert_same_sprites(sprites, expected):
+    records, expected = sprites.records, expected.records
+    assert len(records) == len(expected)
+    for name in ('label', 'top', 'left', 'bottom', 'right', 'area'):
+        np.testing.assert_array_equal(records[name], expected[name])
+    for name in ('centroid_row', 'centroid_col'):
+        np.testing.assert_allclose(records[name], expected[name])
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('options', CASES)
+def test_numpy_engine(make_sheet, mode, options):
+    image, background = make_sheet(mode)
+    expected, expected_map = reference(image, background, **options)
+    sprites, label_map = SpriteSheet(image, background).find_sprites(
+        as_array=True, **options)
+    assert_same_sprites(sprites, expected)
+    np.testing.assert_array_equal(label_map, expected_map)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('options', CASES)
+@pytest.mark.parametrize('tile_size', [7, 16, 64])
+def test_tiled(make_sheet, mode, options, tile_size):
+    image, background = make_sheet(mode, seed=1)
+    expected, expected_map = reference(image, background, **options)
+    sprites, label_map = SpriteSheet(image, background).find_sprites(
+        as_array=True, tile_size=tile_size, **options)
+    assert_same_sprites(sprites, expected)
+    np.testing.assert_array_equal(label_map, expected_map)
+
+
+def test_tiled_label_file(make_sheet, tmp_path):
+    image, background = make_sheet('RGB', seed=2)
+    expected, expected_map = reference(image, background)
+    path = str(tmp_path / 'labels.bin')
+    sprites, label_map = SpriteSheet(image, background).find_sprites(
+        as_array=True, tile_size=16, label_file=path)
+    assert_same_sprites(sprites, expected)
+    assert isinstance(label_map, np.memmap)
+    np.testing.assert_array_equal(label_map, expected_map)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('options', CASES)
+def test_parallel(make_sheet, mode, options):
+    image, background = make_sheet(mode, seed=3, shape=(61, 37))
+    expected, expected_map = reference(image, background, **options)
+    sprites, label_map = SpriteSheet(image, background).find_sprites(
+        as_array=True, workers=3, **options)
+    assert_same_sprites(sprites, expected)
+    np.testing.assert_array_equal(label_map, expected_map)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('options', CASES)
+def test_find_sprite_boxes(make_sheet, mode, options):
+    image, background = make_sheet(mode, seed=4)
+    expected, _ = reference(image, background, **options)
+    sprites = SpriteSheet(image, background).find_sprite_boxes(**options)
+    assert_same_sprites(sprites, expected)
+
+
+def test_array_input(make_sheet):
+    image, background = make_sheet('RGBA', seed=5)
+    expected, expected_map = reference(image, background)
+    sprites, label_map = SpriteSheet(np.asarray(image)).find_sprites(
+        as_array=True)
+    assert_same_sprites(sprites, expected)
+    np.testing.assert_array_equal(label_map, expected_map)
+
+
+def test_empty_and_full_sheets(make_sheet):
+    image, background = make_sheet('L', density=0)
+    for engine in ('numpy', 'python'):
+        # Only faint pixels, all within the tolerance.
+        sprites, label_map = SpriteSheet(image, 0).find_sprites(
+            engine=engine, as_array=True, tolerance=2)
+        assert not len(sprites) and not label_map.any()
+    image = Image.new('RGB', (50, 40), (9, 9, 9))
+    sprites, label_map = SpriteSheet(image, (0, 0, 0)).find_sprites(
+        tile_size=16, as_array=True)
+    assert len(sprites) == 1 and sprites[1].area == label_map.size
+
+
+def test_tiled_label_map_stays_mapped(make_sheet):
+    image, background = make_sheet('L', seed=6)
+    sprites, label_map = SpriteSheet(image, background).find_sprites(
+        tile_size=16)
+    assert isinstance(label_map, np.memmap)
+    assert not label_map.flags.writeable
@@ -0,0 +1,33 @@
+"""Measurement of the detection stages"""
+
+import tracemalloc
+
+from spriteutil_final.instrumentation import instrument
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+def test_records(make_sheet):
+    image, background = make_sheet('RGB')
+    with instrument() as records:
+        SpriteSheet(image, background).find_sprites()
+    stages = [record['stage'] for record in records]
+    assert 'labeling' in stages and 'sprites' in stages
+    assert all(record['peak_bytes'] is None for record in records)
+    assert all(record['pixels'] == 40 * 50 for record in records
+               if record['stage'] == 'labeling')
+
+
+def test_memory_and_callbacks(make_sheet):
+    image, background = make_sheet('L')
+    seen = []
+    with instrument(memory=True) as records:
+        with instrument(seen.append) as nested:
+            SpriteSheet(image, background).find_sprites()
+        SpriteSheet(image, background).find_sprites(min_size=2)
+    assert not nested and len(seen) < len(records)
+    assert all(record['peak_bytes'] > 0 for record in records
+               if record['stage'] == 'labeling')
+    assert not tracemalloc.is_tracing()
+    with instrument() as records:
+        pass
+    assert not records
@@ -0,0 +1,83 @@
+"""Sprite label mask images and sprite iteration"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+def expected_indices(sprites, label_map):
+    """Draw the bounding boxes one sprite at a time, in label order"""
+    indices = np.array(label_map)
+    for label in sprites:
+        sprite = sprites[label]
+        (top, left), (bottom, right) = sprite.top_left, sprite.bottom_right
+        indices[top:bottom + 1, left] = label
+        indices[top:bottom + 1, right] = label
+        indices[top, left:right + 1] = label
+        indices[bottom, left:right + 1] = label
+    return indices
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+def test_labels_image(make_sheet, mode):
+    # Boxes of 8-connected noise overlap a lot.
+    image, background = make_sheet(mode, seed=30, density=0.3)
+    sheet = SpriteSheet(image, background)
+    sprites, label_map = sheet.find_sprites(as_array=True, connectivity=8)
+    mask = np.asarray(sheet.create_sprite_labels_image(seed=1,
+                                                       connectivity=8))
+    indices = expected_indices(sprites, label_map)
+    colors = {}
+    for label, color in zip(indices.reshape(-1).tolist(),
+                            mask.reshape(len(indices.reshape(-1)), -1)
+                            .tolist()):
+        assert colors.setdefault(label, color) == color
+    # Sprites hidden by the boxes of later ones are not drawn.
+    assert len(set(map(tuple, colors.values()))) == len(colors)
+
+
+def test_palette_labels_image(make_sheet):
+    image, background = make_sheet('L', seed=31, density=0.1)
+    sheet = SpriteSheet(image, background)
+    sprites, label_map = sheet.find_sprites(as_array=True)
+    mask = sheet.create_sprite_labels_image(seed=1, palette=True)
+    assert mask.mode == 'P'
+    np.testing.assert_array_equal(np.asarray(mask),
+                                  expected_indices(sprites, label_map))
+
+
+def test_empty_labels_image():
+    sheet = SpriteSheet(Image.new('RGB', (8, 6), (1, 2, 3)), (1, 2, 3))
+    mask = np.asarray(sheet.create_sprite_labels_image())
+    assert (mask == (1, 2, 3)).all()
+
+
+def test_collection_views(make_sheet):
+    image, background = make_sheet('RGB', seed=32)
+    sprites, _ = SpriteSheet(image, background).find_sprites()
+    labels = list(sprites)
+    assert [label for label, _ in sprites.items()] == labels
+    for sprite, (label, same) in zip(sprites.values(), sprites.items()):
+        expected = sprites[label]
+        for item in (sprite, same):
+            assert (item.label, item.top_left, item.bottom_right, item.area,
+                    item.centroid) == \
+                (expected.label, expected.top_left, expected.bottom_right,
+                 expected.area, expected.centroid)
+            assert type(item.label) is int and type(item.area) is int
+
+
+def test_iter_sprites(make_sheet):
+    image, background = make_sheet('RGBA', seed=33)
+    sheet = SpriteSheet(image, background)
+    sprites, label_map = sheet.find_sprites(as_array=True)
+    count = 0
+    for sprite, pixels, mask in sheet.iter_sprites():
+        count += 1
+        np.testing.assert_array_equal(pixels,
+                                      np.asarray(image)[sprite.slices])
+        assert mask.sum() == sprite.area
+        assert (label_map[sprite.slices][mask] == sprite.label).all()
+    assert count == len(sprites)
@@ -0,0 +1,113 @@
+"""Asynchronous detection service"""
+
+import asyncio
+import base64
+import io
+import json
+import threading
+
+import numpy as np
+
+from spriteutil_final import service
+from spriteutil_final.service import DetectionService
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+def test_detect(make_sheet):
+    image, background = make_sheet('RGB')
+    expected, expected_map = SpriteSheet(image, background).find_sprites(
+        as_array=True, connectivity=8)
+
+    async def run():
+        async with DetectionService(workers=1) as detection:
+            return await asyncio.gather(*[
+                detection.detect(source, background, connectivity=8)
+                for source in (image, np.array(image), image)])
+
+    for sprites, label_map in asyncio.run(run()):
+        np.testing.assert_array_equal(sprites.records, expected.records)
+        np.testing.assert_array_equal(label_map, expected_map)
+
+
+def test_key_off_the_event_loop(make_sheet, monkeypatch):
+    image, background = make_sheet('L')
+    threads = []
+    request_key = service._request_key
+
+    def recorded(*arguments):
+        threads.append(threading.current_thread())
+        return request_key(*arguments)
+
+    monkeypatch.setattr(service, '_request_key', recorded)
+
+    async def run():
+        async with DetectionService(workers=1) as detection:
+            await detection.detect(image, background)
+
+    asyncio.run(run())
+    assert threads and threading.main_thread() not in threads
+
+
+def test_socket_requests(make_sheet, tmp_path):
+    image, background = make_sheet('L')
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    data = base64.b64encode(buffer.getvalue()).decode()
+    label_file = str(tmp_path / 'labels')
+    requests = [
+        {'id': 1, 'data': data, 'background_color': background,
+         'options': {'min_size': 2, 'connectivity': 8}},
+        {'id': 2, 'data': data, 'options': {'tile_size': 8,
+                                            'label_file': label_file}},
+        {'id': 3, 'path': str(tmp_path / 'missing.png')},
+        'not json']
+
+    async def run():
+        async with DetectionService(workers=1) as detection:
+            server = await detection.serve(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', port, limit=1 << 24)
+            responses = []
+            for request in requests:
+                line = request if isinstance(request, str) \
+                    else json.dumps(request)
+                writer.write(line.encode() + b'\n')
+                await writer.drain()
+                responses.append(json.loads(await reader.readline()))
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return responses
+
+    first, second, third, fourth = asyncio.run(run())
+    expected, _ = SpriteSheet(image, background).find_sprites(
+        min_size=2, connectivity=8)
+    assert first['id'] == 1 and len(first['sprites']) == len(expected)
+    assert second['error'].startswith('ValueError: Unknown options')
+    assert not (tmp_path / 'labels').exists()
+    assert third['error'].startswith('FileNotFoundError')
+    assert fourth['id'] is None and 'error' in fourth
+
+
+def test_busy(make_sheet):
+    images = [make_sheet('L', seed=seed, shape=(300, 300))[0]
+              for seed in range(4)]
+
+    async def run():
+        async with DetectionService(workers=1, max_pending=1,
+                                    max_queued=1) as detection:
+            results = await asyncio.gather(
+                *[detection.detect(image, 0, min_size=seed)
+                  for seed, image in enumerate(images)],
+                return_exceptions=True)
+            # The queue is free again once the detections are done.
+            await detection.detect(images[0], 0)
+            return results
+
+    results = asyncio.run(run())
+    busy = [result for result in results
+            if isinstance(result, service.ServiceBusy)]
+    assert len(busy) == 2 and all(isinstance(result, tuple)
+                                  for result in results
+                                  if result not in busy)
@@ -0,0 +1,128 @@
+"""Incremental detection of update_sprites against full detection"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from spriteutil_final.spriteutil import SpriteSheet
+
+
+MODES = ('L', 'P', 'RGB', 'RGBA')
+
+CASES = [{'tolerance': 0, 'connectivity': 4, 'min_size': 1},
+         {'tolerance': 2, 'connectivity': 8, 'min_size': 3}]
+
+
+def full_detection(image, background, **options):
+    return SpriteSheet(image.copy(), background).find_sprites(
+        as_array=True, **options)
+
+
+def assert_same(result, expected):
+    sprites, label_map = result
+    np.testing.assert_array_equal(label_map, expected[1])
+    records, expected = sprites.records, expected[0].records
+    for name in ('label', 'top', 'left', 'bottom', 'right', 'area'):
+        np.testing.assert_array_equal(records[name], expected[name])
+    for name in ('centroid_row', 'centroid_col'):
+        np.testing.assert_allclose(records[name], expected[name])
+
+
+def edits(image, seed):
+    """Yield edited copies of an image: scribbles, a filled block which
+    merges sprites, an erased block which splits them and a border edit"""
+    rng = np.random.default_rng(seed)
+    pixels = np.array(image)
+    height, width = pixels.shape[:2]
+    for top, left, bottom, right, fill in [
+            (5, 7, 9, 12, None), (10, 10, 25, 30, 'sprite'),
+            (12, 0, 30, 40, 'background'), (height - 2, width - 6, height,
+                                            width, None)]:
+        window = pixels[top:bottom, left:right]
+        if fill == 'background':
+            window[...] = 0
+        elif fill == 'sprite':
+            window[...] = pixels.max(axis=(0, 1))
+        else:
+            window[...] = rng.permutation(window.reshape(
+                (-1,) + window.shape[2:])).reshape(window.shape)
+        edited = Image.fromarray(pixels.copy(), image.mode)
+        if image.mode == 'P':
+            edited.putpalette(image.getpalette())
+        yield edited, (top, left, bottom - 1, right - 1)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('options', CASES)
+def test_update_with_image(make_sheet, mode, options):
+    image, background = make_sheet(mode, seed=10)
+    sheet = SpriteSheet(image, background)
+    sheet.find_sprites(**options)
+    for edited, _ in edits(image, 10):
+        result = sheet.update_sprites(image=edited, as_array=True, **options)
+        assert_same(result, full_detection(edited, background, **options))
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('options', CASES)
+def test_update_with_dirty_rectangle(make_sheet, mode, options):
+    image, background = make_sheet(mode, seed=11)
+    sheet = SpriteSheet(image, background)
+    sheet.find_sprites(**options)
+    for edited, dirty in edits(image, 11):
+        top, left, bottom, right = dirty
+        sheet.image.paste(edited.crop((left, top, right + 1, bottom + 1)),
+                          (left, top))
+        result = sheet.update_sprites(dirty=dirty, as_array=True, **options)
+        assert_same(result, full_detection(edited, background, **options))
+
+
+@pytest.mark.parametrize('options', CASES)
+def test_update_array_sheet(make_sheet, options):
+    image, background = make_sheet('RGB', seed=12)
+    sheet = SpriteSheet(np.array(image), background)
+    sheet.find_sprites(**options)
+    for edited, _ in edits(image, 12):
+        result = sheet.update_sprites(image=np.array(edited), as_array=True,
+                                      **options)
+        assert_same(result, full_detection(edited, background, **options))
+
+
+def test_update_without_change(make_sheet):
+    image, background = make_sheet('L', seed=13)
+    sheet = SpriteSheet(image, background)
+    expected = sheet.find_sprites(as_array=True)
+    assert_same(sheet.update_sprites(image=image.copy(), as_array=True),
+                expected)
+
+
+def test_update_arguments(make_sheet):
+    image, background = make_sheet('L', seed=14)
+    sheet = SpriteSheet(image, background)
+    with pytest.raises(ValueError):
+        sheet.update_sprites()
+    with pytest.raises(ValueError):
+        sheet.update_sprites(image=image.convert('RGB'))
+    with pytest.raises(ValueError):
+        sheet.update_sprites(dirty=(100, 100, 120, 120))
+
+
+@pytest.mark.parametrize('source', ['array', 'bytes'])
+def test_update_keeps_caller_buffer(make_sheet, source):
+    image, background = make_sheet('RGB', seed=15)
+    pixels = np.array(image)
+    original = pixels.copy()
+    data = pixels if source == 'array' else pixels.tobytes()
+    sheet = SpriteSheet(data, background, mode='RGB',
+                        shape=pixels.shape[:2])
+    sheet.find_sprites()
+    for edited, dirty in edits(image, 15):
+        result = sheet.update_sprites(image=edited, as_array=True)
+        assert_same(result, full_detection(edited, background))
+        # Then an edit drawn on the sheet image, now a PIL image.
+        top, left, bottom, right = dirty
+        sheet.image.paste((255, 0, 0), (left, top, left + 2, top + 2))
+        result = sheet.update_sprites(dirty=(top, left, top + 1, left + 1),
+                                      as_array=True)
+        assert_same(result, full_detection(sheet.image, background))
+    np.testing.assert_array_equal(pixels, original)